@@ -0,0 +1,107 @@
+import os
+import hashlib
+from abc import ABC, abstractmethod
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp'}
+
+def content_hash(image_path):
+    """
+    Compute the SHA-256 hash of a file's content.
+
+    :param image_path: The path of the file.
+    :return: The hash as a hexadecimal string.
+    """
+    digest = hashlib.sha256()
+    with open(image_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class SyncChanges:
+    """The differences between a directory tree and its sync manifest."""
+
+    def __init__(self, added, changed, removed, touched):
+        """
+        Initialise the SyncChanges.
+
+        :param added: Paths of image files not in the manifest.
+        :param changed: Paths of image files whose content changed since they were last synced.
+        :param removed: Paths in the manifest whose image files no longer exist.
+        :param touched: Paths whose size or modification time changed but whose content hash did not.
+        """
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+        self.touched = touched
+
+class IDirectoryScanner(ABC):
+    """Abstract base class for scanning a directory tree for image files."""
+
+    @abstractmethod
+    def scan(self, root):
+        """
+        Find every image file under a directory.
+
+        :param root: The directory to scan.
+        :return: A dictionary mapping the path of each image file relative to root to its (size, modification time in ns).
+        """
+
+class ScandirDirectoryScanner(IDirectoryScanner):
+    """Directory scanner walking the tree with os.scandir, which avoids a stat call per directory entry type."""
+
+    def scan(self, root):
+        """
+        Find every image file under a directory.
+
+        Symbolic links to directories are not followed. Unreadable directories are reported and skipped.
+        Relative paths are built from each directory's relative prefix as the tree is walked.
+
+        :param root: The directory to scan.
+        :return: A dictionary mapping the path of each image file relative to root to its (size, modification time in ns).
+        """
+        image_files = {}
+        directories = [(root, '')]
+        while directories:
+            directory, prefix = directories.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append((entry.path, prefix + entry.name + os.sep))
+                        elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                            stat = entry.stat()
+                            image_files[prefix + entry.name] = (stat.st_size, stat.st_mtime_ns)
+            except OSError as e:
+                print(f"Error: {e}")
+        return image_files
+
+def find_sync_changes(root, image_files, manifest, use_hash):
+    """
+    Compare scanned image files with a sync manifest.
+
+    Files whose size and modification time match the manifest are taken as unchanged without
+    reading them. With use_hash, files whose size or modification time differ are hashed and
+    only count as changed if their content hash differs too.
+
+    :param root: The synced directory, which image paths are relative to.
+    :param image_files: A dictionary mapping image paths relative to root to (size, modification time in ns).
+    :param manifest: A dictionary mapping synced image paths to [size, modification time in ns, content hash or None].
+    :param use_hash: If True, compare content hashes of files whose size or modification time changed.
+    :return: The SyncChanges.
+    """
+    added, changed, touched = [], [], []
+    for image_path, (size, mtime_ns) in image_files.items():
+        entry = manifest.get(image_path)
+        if entry is None:
+            added.append(image_path)
+        elif (entry[0], entry[1]) != (size, mtime_ns):
+            try:
+                unchanged_content = use_hash and entry[2] is not None and entry[2] == content_hash(os.path.join(root, image_path))
+            except OSError:
+                unchanged_content = False
+            if unchanged_content:
+                touched.append(image_path)
+            else:
+                changed.append(image_path)
+    removed = [image_path for image_path in manifest if image_path not in image_files]
+    return SyncChanges(sorted(added), sorted(changed), sorted(removed), sorted(touched))
@@ -1,5 +1,6 @@
 import click
 from image_search_manager import ImageSearchManager
+from spatial_index import RegionQuery
 
 @click.group()
 def main():
@@ -12,27 +13,55 @@ def main():
 #
 
 @main.command()
+@click.option('--dedup/--no-dedup', default=True, show_default=True, help='Reuse the detections of a stored near-duplicate instead of running detection')
 @click.argument('image_path', type=click.Path(exists=True, dir_okay=False))
-def add(image_path):
+def add(dedup, image_path):
     """Ingest an image, detect objects, and store the image and detected objects in a CSV file."""
     image_search_manager = ImageSearchManager(object_detection_engine_type='default')
-    image_search_manager.ingest_image(image_path)
+    image_search_manager.ingest_image(image_path, dedup)
 
 @main.command()
 @click.option('--all/--some', default=True, show_default=True, help='List images that match all/some query terms')
+@click.option('--region', nargs=4, type=click.FloatRange(0.0, 1.0), default=None, metavar='X0 Y0 X1 Y1', help='Only match objects whose box centre lies in this normalised region')
+@click.option('--min-area', default=None, type=click.FloatRange(0.0, 1.0), help='Only match objects covering at least this fraction of the frame')
+@click.option('--max-area', default=None, type=click.FloatRange(0.0, 1.0), help='Only match objects covering at most this fraction of the frame')
+@click.option('--min-confidence', default=None, type=click.FloatRange(0.0, 1.0), help='Only match objects detected with at least this score')
 @click.argument('terms', nargs=-1, required=True)
-def search(all, terms):
+def search(all, region, min_area, max_area, min_confidence, terms):
     """Retrieve images based on object types from the CSV file."""
+    if region is not None and (region[0] > region[2] or region[1] > region[3]):
+        raise click.BadParameter('X0 must not exceed X1 and Y0 must not exceed Y1', param_hint='--region')
+    region_query = RegionQuery(region, min_area, max_area, min_confidence)
     image_search_manager = ImageSearchManager(object_detection_engine_type='default')
-    image_search_manager.retrieve_images_matching_terms(all, terms)
+    image_search_manager.retrieve_images_matching_terms(all, terms, region_query)
 
 @main.command()
 @click.option('--k', default=1, type=click.IntRange(1), show_default=True, help='Number of matches to return')
+@click.option('--min-score', default=None, type=click.FloatRange(0.0, 1.0), help='Leave out matches scoring below this similarity')
+@click.option('--max-memory', default=None, type=click.FloatRange(min=0.0, min_open=True), help='Approximate memory ceiling in MB for scoring the index')
 @click.argument('image_path', type=click.Path(exists=True, dir_okay=False))
-def similar(k, image_path):
+def similar(k, min_score, max_memory, image_path):
     """Retrieve similar images based on cosine similarity of object types using data from the CSV file."""
     image_search_manager = ImageSearchManager(object_detection_engine_type='default')
-    image_search_manager.retrieve_similar_images(k, image_path)
+    image_search_manager.retrieve_similar_images(k, image_path, min_score, max_memory)
+
+@main.command()
+@click.option('--hash/--no-hash', 'use_hash', default=False, show_default=True, help='Keep content hashes so files that were only touched are not re-ingested')
+@click.option('--batch-size', default=32, type=click.IntRange(1), show_default=True, help='Number of images to ingest per published batch')
+@click.option('--dedup/--no-dedup', default=True, show_default=True, help='Reuse the detections of a stored near-duplicate instead of running detection')
+@click.argument('root', type=click.Path(exists=True, file_okay=False))
+def sync(use_hash, batch_size, dedup, root):
+    """Ingest new and changed images under a directory and remove index entries of deleted ones."""
+    image_search_manager = ImageSearchManager(object_detection_engine_type='default')
+    image_search_manager.sync_directory(root, use_hash, batch_size, dedup)
+
+@main.command()
+@click.option('--batch-size', default=32, type=click.IntRange(1), show_default=True, help='Number of images to re-detect per published batch')
+@click.option('--limit', default=None, type=click.IntRange(1), help='Maximum number of images to re-detect in this run')
+def redetect(batch_size, limit):
+    """Re-detect objects in images whose stored detections came from a different model."""
+    image_search_manager = ImageSearchManager(object_detection_engine_type='default')
+    image_search_manager.redetect_stale_images(batch_size, limit)
 
 @main.command()
 def list():
@@ -1,58 +1,219 @@
+import os
+import time
 from index_access import IndexAccess
+from segment_store import INDEX_DIR
 from image_access import ImageAccess, ImreadImageLoader
 from printing_engine import PrintingEngine
 from matching_engine import MatchingEngine
 from object_detection_engine import ObjectDetectionEngineFactory
+from similarity_utility import chunk_size_for_memory
+from directory_sync import ScandirDirectoryScanner, content_hash, find_sync_changes
+from perceptual_hash import DUPLICATE_MAX_DISTANCE, DctPerceptualHasher, hamming_distances
+
+# Seconds between saves of the sync manifest while a sync is ingesting files.
+SYNC_MANIFEST_SAVE_INTERVAL = 60
 
 class ImageSearchManager:
     """Manages image data, object detection, and searching for images based on object types."""
 
-    def __init__(self, object_detection_engine_type):
+    def __init__(self, object_detection_engine_type, index_dir=INDEX_DIR):
         """
         Initialise the ImageSearchManager with the specified object detection engine type.
 
         :param object_detection_engine_type: The type of object detection engine to use.
+        :param index_dir: The directory holding the index segments.
         """
-        self.index_access = IndexAccess()
+        self.index_access = IndexAccess(index_dir)
         self.image_loader = ImreadImageLoader()
         self.image_access = ImageAccess(self.image_loader)
-        self.printing_engine = PrintingEngine()
-        self.matching_engine = MatchingEngine()
+        self.printing_engine = PrintingEngine(index_dir)
+        self.matching_engine = MatchingEngine(index_dir)
         self.object_detection_engine = ObjectDetectionEngineFactory.create_object_detection_engine(object_detection_engine_type)
+        self.directory_scanner = ScandirDirectoryScanner()
+        self.perceptual_hasher = DctPerceptualHasher()
         self.index_access.setup_csv_file()
 
-    def ingest_image(self, image_path):
+    def ingest_image(self, image_path, deduplicate=True):
         """
         Ingest an image, detect objects, and store the image and detected objects in a CSV file.
 
         :param image_path: The path to the image file to ingest.
+        :param deduplicate: If True, near-duplicates of stored images reuse their detections instead of running detection.
+        """
+        image_data = self.analyse_image(image_path, deduplicate)
+        if image_data is None:
+            image_data = (image_path, set(), [], self.object_detection_engine.get_model_fingerprint(), None, '')
+        self.index_access.save_image_data(*image_data)
+        if image_data[5]:
+            self.printing_engine.print_near_duplicate(image_path, image_data[5])
+        self.printing_engine.print_detection_results(image_data[1])
+
+    def analyse_image(self, image_path, deduplicate=True, pending=()):
+        """
+        Work out the image data to store for an image.
+
+        A perceptual hash is computed from a cheap, reduced-scale decode of the image. If it is
+        within DUPLICATE_MAX_DISTANCE of a stored or pending image whose labels came from the
+        current model, the image is linked to that image as a variant and reuses its labels and boxes; only
+        otherwise is the image fully decoded and run through object detection.
+
+        :param image_path: The path to the image file.
+        :param deduplicate: If True, look for a near-duplicate before running detection.
+        :param pending: Image data not yet saved, such as the rest of a batch, also checked for near-duplicates.
+        :return: A (image path, detected objects, detections, model fingerprint, perceptual hash, variant of) tuple,
+            or None if the image cannot be read.
         """
+        model_fingerprint = self.object_detection_engine.get_model_fingerprint()
+        perceptual_hash = self.perceptual_hasher.hash_image(image_path)
+        if deduplicate and perceptual_hash is not None:
+            duplicate = self.find_near_duplicate(image_path, perceptual_hash, pending)
+            if duplicate is not None and duplicate[3] == model_fingerprint:
+                original_path, detected_objects, detections, _ = duplicate
+                return image_path, set(detected_objects), detections, model_fingerprint, perceptual_hash, original_path
         image = self.image_access.read_image_path(image_path)
-        detected_objects = self.object_detection_engine.use_object_detector(image)
-        self.index_access.save_image_data(image_path, detected_objects)
-        self.printing_engine.print_detection_results(detected_objects)
+        if image is None:
+            return None
+        detections = self.object_detection_engine.use_box_detector(image) or []
+        detected_objects = set(label for label, *_ in detections)
+        return image_path, detected_objects, detections, model_fingerprint, perceptual_hash, ''
+
+    def find_near_duplicate(self, image_path, perceptual_hash, pending=()):
+        """
+        Find a stored or pending near-duplicate of an image.
+
+        :param image_path: The path of the image, which does not count as its own duplicate.
+        :param perceptual_hash: The perceptual hash of the image.
+        :param pending: Image data tuples, as returned by analyse_image, not yet saved.
+        :return: The (image path, detected objects, detections, model fingerprint) of the original image, or None.
+        """
+        for other_path, detected_objects, detections, model_fingerprint, other_hash, variant_of in pending:
+            if other_hash is not None and image_path not in (other_path, variant_of) \
+                    and hamming_distances([other_hash], perceptual_hash)[0] <= DUPLICATE_MAX_DISTANCE:
+                return variant_of or other_path, detected_objects, detections, model_fingerprint
+        return self.index_access.find_near_duplicate(perceptual_hash, exclude_path=image_path)
+
+    def sync_directory(self, root, use_hash, batch_size, deduplicate=True):
+        """
+        Bring the index in line with the image files under a directory.
+
+        Only files that are new or changed since the last sync of the directory are read and run
+        through object detection; index entries of files that were removed are deleted. The sync
+        manifest is saved periodically while ingesting, and new files are saved replacing any
+        existing entries, so an interrupted sync can simply be run again.
+
+        The manifest records paths relative to the directory and the index stores absolute paths,
+        so syncing the same directory by a different relative path finds the files unchanged.
+
+        :param root: The directory to sync.
+        :param use_hash: If True, keep content hashes and treat files whose content is unchanged as unchanged.
+        :param batch_size: The number of images to ingest per published batch.
+        :param deduplicate: If True, near-duplicates of stored images reuse their detections instead of running detection.
+        """
+        root = os.path.abspath(root)
+        image_files = self.directory_scanner.scan(root)
+        manifest = self.index_access.read_sync_manifest(root)
+        changes = find_sync_changes(root, image_files, manifest, use_hash)
+        if changes.removed:
+            self.index_access.delete_image_data([os.path.join(root, relative_path) for relative_path in changes.removed])
+            for relative_path in changes.removed:
+                del manifest[relative_path]
+        for relative_path in changes.touched:
+            manifest[relative_path] = [*image_files[relative_path], manifest[relative_path][2]]
+        to_ingest = changes.added + changes.changed
+        failed = []
+        last_save = time.monotonic()
+        for start in range(0, len(to_ingest), batch_size):
+            image_data = []
+            for relative_path in to_ingest[start:start + batch_size]:
+                image_path = os.path.join(root, relative_path)
+                try:
+                    data = self.analyse_image(image_path, deduplicate, image_data)
+                    file_hash = content_hash(image_path) if use_hash else None
+                except Exception as e:
+                    print(f"Error: {e}")
+                    data = None
+                if data is None:
+                    failed.append(image_path)
+                    continue
+                image_data.append(data)
+                manifest[relative_path] = [*image_files[relative_path], file_hash]
+            self.index_access.upsert_image_data(image_data)
+            if time.monotonic() - last_save > SYNC_MANIFEST_SAVE_INTERVAL:
+                self.index_access.save_sync_manifest(root, manifest)
+                last_save = time.monotonic()
+        if changes.removed or changes.touched or to_ingest:
+            self.index_access.save_sync_manifest(root, manifest)
+        self.printing_engine.print_sync_report(*([os.path.join(root, relative_path) for relative_path in relative_paths]
+                                                 for relative_paths in (changes.added, changes.changed, changes.removed)),
+                                               failed)
+
+    def redetect_stale_images(self, batch_size, limit=None):
+        """
+        Re-detect objects in images whose stored detections came from a different model.
+
+        Each batch replaces its rows in a single new index generation and then updates the
+        checkpoint, so queries keep serving the old detections until a batch is published and an
+        interrupted run resumes with the rows that are still stale. Images that cannot be read or
+        analysed are recorded as failed in the checkpoint and skipped by later runs.
+
+        :param batch_size: The number of images to re-detect per published batch.
+        :param limit: If given, the maximum number of images to re-detect in this run.
+        """
+        model_fingerprint = self.object_detection_engine.get_model_fingerprint()
+        checkpoint = self.index_access.read_redetect_checkpoint(model_fingerprint)
+        failed = set(checkpoint["failed"])
+        stale_images = [path for path in self.index_access.access_stale_images(model_fingerprint) if path not in failed]
+        if limit is not None:
+            stale_images = stale_images[:limit]
+        completed = 0
+        for start in range(0, len(stale_images), batch_size):
+            image_data = []
+            for image_path in stale_images[start:start + batch_size]:
+                try:
+                    data = self.analyse_image(image_path, pending=image_data)
+                except Exception as e:
+                    print(f"Error: {e}")
+                    data = None
+                if data is None:
+                    failed.add(image_path)
+                    continue
+                image_data.append(data)
+            self.index_access.replace_image_data(image_data)
+            completed += len(image_data)
+            checkpoint["completed"] += len(image_data)
+            checkpoint["failed"] = sorted(failed)
+            self.index_access.save_redetect_checkpoint(checkpoint)
+            self.printing_engine.print_redetect_progress(completed, len(stale_images))
+        self.printing_engine.print_redetect_summary(completed, len(failed))
 
-    def retrieve_images_matching_terms(self, all, terms):
+    def retrieve_images_matching_terms(self, all, terms, region_query=None):
         """
         Retrieve images based on object types from the CSV file.
 
         :param all: If True, retrieve images that match all query terms. If False, retrieve images that match some of the terms.
         :param terms: A list of query terms to search for in the images.
+        :param region_query: An optional RegionQuery on the position, size and confidence of the matching detections.
         """
         term_set = set(terms)
-        matching_images = self.matching_engine.find_matching_images(all, term_set)
+        if region_query is None or region_query.is_empty():
+            matching_images = self.matching_engine.find_matching_images(all, term_set)
+        else:
+            matching_images = self.matching_engine.find_images_matching_regions(all, term_set, region_query)
         self.printing_engine.print_matching_images(matching_images)
 
-    def retrieve_similar_images(self, k, image_path):
+    def retrieve_similar_images(self, k, image_path, min_score=None, max_memory_mb=None):
         """
         Retrieve similar images based on cosine similarity of object types using data from the CSV file.
 
         :param k: The number of similar images to return.
         :param image_path: The path to the image for which to find similar images.
+        :param min_score: If given, images scoring below this value are left out.
+        :param max_memory_mb: If given, the approximate memory ceiling in megabytes for scoring the index.
         """
         image = self.image_access.read_image_path(image_path)
         input_labels = self.object_detection_engine.use_object_detector(image)
-        similarity_scores = self.matching_engine.get_similar_images(input_labels)
+        chunk_size = chunk_size_for_memory(max_memory_mb)
+        similarity_scores = self.matching_engine.get_top_k_similar_images(input_labels, k, min_score, chunk_size)
         self.printing_engine.print_similar_images(image_path, similarity_scores, k)
 
     def list_images(self):
@@ -1,9 +1,16 @@
 import os
+import hashlib
 from abc import ABC, abstractmethod
 import csv
-from similarity_utility import CosineSimilarityMetric, SimilarityUtility
+import numpy as np
+from similarity_utility import DEFAULT_CHUNK_SIZE, CosineSimilarityMetric, SimilarityUtility
+from segment_store import INDEX_DIR, SegmentStore
+from spatial_index import GridSpatialIndex, decode_detections, encode_detections
+from perceptual_hash import DUPLICATE_MAX_DISTANCE, MultiIndexHashIndex
+from label_index import LabelIndex, all_known_labels, label_mask, label_matrix
 
 CSV_FILE = 'image_data.csv'
+REDETECT_CHECKPOINT_FILE = 'redetect.json'
 
 class IIndexAccess(ABC):
     """Abstract base class for index access."""
@@ -13,8 +20,87 @@ class IIndexAccess(ABC):
         """Set up the CSV file for image data storage."""
 
     @abstractmethod
-    def save_image_data(self, image_path, detected_objects):
-        """Save image data, including detected objects, to the CSV file."""
+    def save_image_data(self, image_path, detected_objects, detections=(), model_fingerprint='', perceptual_hash=None, variant_of=''):
+        """Save image data, including detected objects, their boxes and the model that detected them, to the CSV file."""
+
+    @abstractmethod
+    def replace_image_data(self, image_data):
+        """
+        Replace the stored data of already indexed images.
+
+        :param image_data: A list of (image path, detected objects, detections, model fingerprint) tuples.
+        """
+
+    @abstractmethod
+    def upsert_image_data(self, image_data):
+        """
+        Save image data, replacing any stored data of the same images.
+
+        :param image_data: A list of (image path, detected objects, detections, model fingerprint) tuples.
+        """
+
+    @abstractmethod
+    def delete_image_data(self, image_paths):
+        """
+        Delete the stored data of images.
+
+        :param image_paths: The paths of the images to delete.
+        """
+
+    @abstractmethod
+    def read_sync_manifest(self, root):
+        """
+        Read the manifest of image files last synced from a directory.
+
+        :param root: The synced directory, as an absolute path.
+        :return: A dictionary mapping image paths relative to root to [size, modification time in ns, content hash or None].
+        """
+
+    @abstractmethod
+    def save_sync_manifest(self, root, manifest):
+        """
+        Save the manifest of image files synced from a directory.
+
+        :param root: The synced directory, as an absolute path.
+        :param manifest: A dictionary mapping image paths relative to root to [size, modification time in ns, content hash or None].
+        """
+
+    @abstractmethod
+    def find_near_duplicate(self, perceptual_hash, exclude_path=None, max_distance=DUPLICATE_MAX_DISTANCE):
+        """
+        Find the stored image whose perceptual hash is closest to a hash, within a Hamming distance.
+
+        :param perceptual_hash: The perceptual hash to look up, as an int.
+        :param exclude_path: An image path that does not count as a match.
+        :param max_distance: The largest Hamming distance that counts as a near-duplicate.
+        :return: The (image path, detected objects, detections, model fingerprint) of the original image, or None.
+        """
+
+    @abstractmethod
+    def access_stale_images(self, model_fingerprint):
+        """
+        Access and return the paths of images detected by a model other than the given one.
+
+        :param model_fingerprint: The fingerprint of the current model.
+        :return: A list of image paths, in the order they should be re-detected.
+        """
+
+    @abstractmethod
+    def read_redetect_checkpoint(self, model_fingerprint):
+        """
+        Read the progress of re-detecting stale images with a model.
+
+        :param model_fingerprint: The fingerprint of the model images are re-detected with.
+        :return: The checkpoint as a dictionary.
+        """
+
+    @abstractmethod
+    def save_redetect_checkpoint(self, checkpoint):
+        """
+        Save the progress of re-detecting stale images.
+
+        :param checkpoint: The checkpoint as a dictionary.
+        """
 
     @abstractmethod
     def access_matching_images(self, all, term_set):
@@ -23,113 +109,403 @@ class IIndexAccess(ABC):
 
         :param all: If True, return images matching all query terms. If False, return images matching some query terms.
         :param term_set: A set of query terms.
-        :return: A list of matching images and their detected objects.
+        :return: A list of ImageRecords of the matching images.
+        """
+
+    @abstractmethod
+    def access_images_matching_regions(self, all, term_set, region_query):
+        """
+        Access and return images whose detections of the query terms satisfy a region query.
+
+        :param all: If True, return images matching all query terms. If False, return images matching some query terms.
+        :param term_set: A set of query terms.
+        :param region_query: The RegionQuery a detection of a term must satisfy for the term to match.
+        :return: A list of ImageRecords of the matching images.
         """
 
     @abstractmethod
     def read_image_data(self):
-        """Read image data from the CSV file and return it."""
+        """Read image data from the CSV file and return it as a list of ImageRecords."""
 
     @abstractmethod
     def calculate_similarity_scores(self, input_labels):
         """Calculate and return similarity scores based on input labels."""
 
+    @abstractmethod
+    def calculate_top_k_similarity_scores(self, input_labels, k, min_score=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Calculate and return the k best similarity scores, reading the index in chunks.
+
+        :param input_labels: A list of input labels for similarity calculation.
+        :param k: The number of similarity scores to return.
+        :param min_score: If given, scores below this value are discarded.
+        :param chunk_size: The number of rows to score at once.
+        :return: A list of at most k (image path, similarity score) pairs, best first.
+        """
+
     @abstractmethod
     def get_total_num_images(self):
         """Get the total number of images in the CSV file."""
 
 class IndexAccess(IIndexAccess):
     """
-    Implementation of IndexAccess for accessing and managing image data stored in a CSV file.
+    Implementation of IndexAccess for accessing and managing image data stored in CSV segments.
+
+    Image data lives in a SegmentStore: every read works on a pinned snapshot of one
+    generation, so queries never block on, or see partial rows from, a concurrent ingest.
+    Writes that time out waiting for another writer raise LockTimeoutError rather than
+    being reported and dropped, so an image is never silently left out of the index.
     """
 
-    def __init__(self):
+    def __init__(self, index_dir=INDEX_DIR):
         """
         Initialize the IndexAccess object and set up necessary components.
 
-        Initializes the CSV file, similarity metric, and similarity utility.
+        Initializes the spatial, perceptual hash and label indexes, segment store, similarity metric, and similarity utility.
+
+        :param index_dir: The directory holding the index segments.
         """
         self.csv_file = CSV_FILE
+        self.spatial_index = GridSpatialIndex()
+        self.hash_index = MultiIndexHashIndex()
+        self.label_index = LabelIndex()
+        self.segment_store = SegmentStore(index_dir, [self.spatial_index, self.hash_index, self.label_index])
         self.similarity_metric = CosineSimilarityMetric()
         self.similarity_utility = SimilarityUtility(self.similarity_metric)
 
     def setup_csv_file(self):
-        """Set up the CSV file for image data storage if it doesn't exist."""
-        if not os.path.exists(self.csv_file):
-            with open(self.csv_file, mode='w', newline='') as file:
-                try:
-                    writer = csv.writer(file)
-                    writer.writerow(["Image_Path", "Detected_Objects"])
-                except (csv.Error, IOError) as e:
-                    print(f"Error: {e}")
+        """
+        Set up the segment store for image data storage if it doesn't exist.
 
-    def save_image_data(self, image_path, detected_objects):
+        Rows in a legacy single-file CSV index are imported into the first segment.
         """
-        Save image data, including detected objects, to the CSV file.
+        if self.segment_store.exists():
+            return
+        try:
+            self.segment_store.setup()
+            if os.path.exists(self.csv_file):
+                with open(self.csv_file, mode='r', newline='') as file:
+                    reader = csv.reader(file)
+                    next(reader, None)
+                    self.segment_store.publish(list(reader))
+        except (csv.Error, IOError) as e:
+            print(f"Error: {e}")
+
+    def save_image_data(self, image_path, detected_objects, detections=(), model_fingerprint='', perceptual_hash=None, variant_of=''):
+        """
+        Save image data, including detected objects, their boxes and the model that detected them, as a new index segment.
 
         :param image_path: The path of the image to be saved.
         :param detected_objects: A list of detected objects in the image.
+        :param detections: A list of (label, score, ymin, xmin, ymax, xmax) detections in the image.
+        :param model_fingerprint: The fingerprint of the model that detected the objects.
+        :param perceptual_hash: The perceptual hash of the image, as an int.
+        :param variant_of: The path of the image this image is a near-duplicate of, whose labels and boxes it reuses.
+        """
+        try:
+            self.segment_store.publish([self.image_row(image_path, detected_objects, detections, model_fingerprint,
+                                                       perceptual_hash, variant_of)])
+        except (csv.Error, IOError) as e:
+            print(f"Error: {e}")
+
+    def replace_image_data(self, image_data):
+        """
+        Replace the stored data of already indexed images in a single new generation.
+
+        Images removed from the index in the meantime are not added back.
+
+        :param image_data: A list of (image path, detected objects, detections, model fingerprint[, perceptual hash,
+            variant of]) tuples.
+        """
+        try:
+            self.segment_store.replace([self.image_row(*data) for data in image_data])
+        except (csv.Error, IOError) as e:
+            print(f"Error: {e}")
+
+    def upsert_image_data(self, image_data):
+        """
+        Save image data in a single new generation, replacing any stored data of the same images.
+
+        :param image_data: A list of (image path, detected objects, detections, model fingerprint[, perceptual hash,
+            variant of]) tuples.
+        """
+        try:
+            self.segment_store.publish([self.image_row(*data) for data in image_data],
+                                       [data[0] for data in image_data])
+        except (csv.Error, IOError) as e:
+            print(f"Error: {e}")
+
+    def delete_image_data(self, image_paths):
         """
-        with open(self.csv_file, mode='a', newline='') as file:
+        Delete the stored data of images in a single new generation.
+
+        :param image_paths: The paths of the images to delete.
+        """
+        try:
+            self.segment_store.publish([], image_paths)
+        except (csv.Error, IOError) as e:
+            print(f"Error: {e}")
+
+    def read_sync_manifest(self, root):
+        """
+        Read the manifest of image files last synced from a directory.
+
+        :param root: The synced directory, as an absolute path.
+        :return: A dictionary mapping image paths relative to root to [size, modification time in ns, content hash or None].
+        """
+        state = self.segment_store.read_state(self.sync_manifest_name(root))
+        return {} if state is None else state["files"]
+
+    def save_sync_manifest(self, root, manifest):
+        """
+        Save the manifest of image files synced from a directory.
+
+        :param root: The synced directory, as an absolute path.
+        :param manifest: A dictionary mapping image paths relative to root to [size, modification time in ns, content hash or None].
+        """
+        try:
+            self.segment_store.write_state(self.sync_manifest_name(root),
+                                           {"root": root, "files": manifest})
+        except IOError as e:
+            print(f"Error: {e}")
+
+    def sync_manifest_name(self, root):
+        """Return the file name of the sync manifest of a directory."""
+        return f"sync-{hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]}.json"
+
+    def image_row(self, image_path, detected_objects, detections, model_fingerprint, perceptual_hash=None, variant_of=''):
+        """
+        Build an index row from image data.
+
+        Rows of near-duplicate variants hold copies of the labels and boxes of their original image.
+        Boxes are normalised to the frame, so they hold for resized copies as well.
+
+        :return: The row as a list of values in index header order.
+        """
+        return [image_path, ",".join(detected_objects), encode_detections(detections),
+                model_fingerprint, "" if perceptual_hash is None else f"{perceptual_hash:016x}", variant_of]
+
+    def find_near_duplicate(self, perceptual_hash, exclude_path=None, max_distance=DUPLICATE_MAX_DISTANCE):
+        """
+        Find the stored image whose perceptual hash is closest to a hash, within a Hamming distance.
+
+        If the closest match is itself a variant, the image it is a variant of is returned, so
+        every variant links directly to an image whose detections were actually computed.
+
+        :param perceptual_hash: The perceptual hash to look up, as an int.
+        :param exclude_path: An image path that does not count as a match.
+        :param max_distance: The largest Hamming distance that counts as a near-duplicate.
+        :return: The (image path, detected objects, detections, model fingerprint) of the original image, or None.
+        """
+        with self.segment_store.snapshot() as snapshot:
+            try:
+                for _, segment, row_number in self.hash_index.find_near_duplicates(snapshot, perceptual_hash, max_distance):
+                    row = snapshot.read_row(segment, row_number)
+                    if row is None or row["Image_Path"] == exclude_path or row["Variant_Of"] == exclude_path:
+                        continue
+                    original_path = row["Variant_Of"] or row["Image_Path"]
+                    detected_objects = [label for label in row["Detected_Objects"].split(",") if label]
+                    return original_path, detected_objects, decode_detections(row["Detections"]), row["Model_Fingerprint"]
+            except (csv.Error, IOError) as e:
+                print(f"Error: {e}")
+        return None
+
+    def access_stale_images(self, model_fingerprint):
+        """
+        Access and return the paths of images detected by a model other than the given one.
+
+        Images with no recorded model come first, then the most recently ingested images, and
+        near-duplicate variants last, so they can link to their freshly re-detected originals.
+
+        :param model_fingerprint: The fingerprint of the current model.
+        :return: A list of image paths, in the order they should be re-detected.
+        """
+        unversioned, outdated, variants = [], [], []
+        with self.segment_store.snapshot() as snapshot:
             try:
-                writer = csv.writer(file)
-                writer.writerow([image_path, ",".join(detected_objects)])
+                for row in snapshot.rows():
+                    fingerprint = row.get("Model_Fingerprint") or ''
+                    if fingerprint == model_fingerprint:
+                        continue
+                    if row.get("Variant_Of"):
+                        variants.append(row["Image_Path"])
+                    elif not fingerprint:
+                        unversioned.append(row["Image_Path"])
+                    else:
+                        outdated.append(row["Image_Path"])
             except (csv.Error, IOError) as e:
                 print(f"Error: {e}")
+        return list(dict.fromkeys(unversioned[::-1] + outdated[::-1] + variants[::-1]))
+
+    def read_redetect_checkpoint(self, model_fingerprint):
+        """
+        Read the progress of re-detecting stale images with a model.
+
+        A checkpoint left by a run with a different model is discarded.
+
+        :param model_fingerprint: The fingerprint of the model images are re-detected with.
+        :return: The checkpoint as a dictionary.
+        """
+        checkpoint = self.segment_store.read_state(REDETECT_CHECKPOINT_FILE)
+        if checkpoint is None or checkpoint["model_fingerprint"] != model_fingerprint:
+            checkpoint = {"model_fingerprint": model_fingerprint, "completed": 0, "failed": []}
+        return checkpoint
+
+    def save_redetect_checkpoint(self, checkpoint):
+        """
+        Save the progress of re-detecting stale images.
+
+        :param checkpoint: The checkpoint as a dictionary.
+        """
+        try:
+            self.segment_store.write_state(REDETECT_CHECKPOINT_FILE, checkpoint)
+        except IOError as e:
+            print(f"Error: {e}")
 
     def access_matching_images(self, all, term_set):
         """
         Access and return matching images based on query terms.
 
+        The terms are converted to a label mask once, and each segment's label masks are then
+        matched against it in one vectorised pass; only the image paths of matching rows are read.
+
         :param all: If True, return images matching all query terms. If False, return images matching some query terms.
         :param term_set: A set of query terms.
-        :return: A list of matching images and their detected objects.
+        :return: A list of ImageRecords of the matching images.
         """
+        if all and not all_known_labels(term_set):
+            return []
+        query_mask = label_mask(term_set)
         matching_images = []
-        with open(self.csv_file, mode='r') as file:
+        with self.segment_store.snapshot() as snapshot:
             try:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    image_path = row["Image_Path"]
-                    detected_objects = row["Detected_Objects"].split(",")
-                    if all:
-                        if term_set.issubset(detected_objects):
-                            matching_images.append((image_path, detected_objects))
-                    else:
-                        if term_set.intersection(detected_objects):
-                            matching_images.append((image_path, detected_objects))
+                for segment in snapshot.segments:
+                    row_numbers, masks = self.label_index.match_rows(snapshot, segment, all, query_mask)
+                    matching_images.extend(self.label_index.records(snapshot, segment, row_numbers, masks))
+            except (csv.Error, IOError) as e:
+                print(f"Error: {e}")
+        return matching_images
+
+    def access_images_matching_regions(self, all, term_set, region_query):
+        """
+        Access and return images whose detections of the query terms satisfy a region query.
+
+        Each segment's spatial index is consulted per term, and only the matching rows of the
+        segment are then read, so no image or model is touched.
+
+        :param all: If True, return images matching all query terms. If False, return images matching some query terms.
+        :param term_set: A set of query terms.
+        :param region_query: The RegionQuery a detection of a term must satisfy for the term to match.
+        :return: A list of ImageRecords of the matching images.
+        """
+        matching_images = []
+        with self.segment_store.snapshot() as snapshot:
+            try:
+                for segment in snapshot.segments:
+                    segment_path = snapshot.segment_path(segment)
+                    row_sets = [set(self.spatial_index.find_rows(segment_path, term, region_query).tolist())
+                                for term in term_set]
+                    matching_rows = set.intersection(*row_sets) if all else set.union(*row_sets)
+                    if not matching_rows:
+                        continue
+                    row_numbers, masks = self.label_index.select_rows(snapshot, segment, np.array(sorted(matching_rows)))
+                    matching_images.extend(self.label_index.records(snapshot, segment, row_numbers, masks))
             except (csv.Error, IOError) as e:
                 print(f"Error: {e}")
         return matching_images
 
     def read_image_data(self):
-        """Read image data from the CSV file and return it."""
-        with open(self.csv_file, mode='r') as file:
+        """Read image data from the CSV file and return it as a list of ImageRecords."""
+        image_data = []
+        with self.segment_store.snapshot() as snapshot:
             try:
-                reader = csv.DictReader(file)
-                return [(row["Image_Path"], row["Detected_Objects"].split(",")) for row in reader]
+                for segment in snapshot.segments:
+                    row_numbers, masks = self.label_index.select_rows(snapshot, segment)
+                    image_data.extend(self.label_index.records(snapshot, segment, row_numbers, masks))
             except (csv.Error, IOError) as e:
                 print(f"Error: {e}")
+        return image_data
 
     def calculate_similarity_scores(self, input_labels):
         """
         Calculate and return similarity scores based on input labels.
 
+        Every image is scored on the same label-mask path as calculate_top_k_similarity_scores,
+        with k large enough to keep them all.
+
         :param input_labels: A list of input labels for similarity calculation.
-        :return: A list of similarity scores.
+        :return: A list of (image path, similarity score) pairs, best first.
         """
-        with open(self.csv_file, mode='r') as file:
+        similarity_scores = []
+        with self.segment_store.snapshot() as snapshot:
             try:
-                reader = csv.DictReader(file)
-                similarity_scores = self.similarity_utility.process_similarity_scores(reader, input_labels)
+                best = self.similarity_utility.process_top_k_label_matrices(
+                    self.label_matrix_chunks(snapshot, DEFAULT_CHUNK_SIZE), input_labels, snapshot.count_rows())
+                similarity_scores = self.resolve_image_paths(snapshot, best)
             except (csv.Error, IOError) as e:
                 print(f"Error: {e}")
         return similarity_scores
 
-    def get_total_num_images(self):
-        """Get the total number of images in the CSV file."""
-        with open(CSV_FILE, mode='r') as file:
+    def calculate_top_k_similarity_scores(self, input_labels, k, min_score=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Calculate and return the k best similarity scores, reading the index in chunks.
+
+        :param input_labels: A list of input labels for similarity calculation.
+        :param k: The number of similarity scores to return.
+        :param min_score: If given, scores below this value are discarded.
+        :param chunk_size: The number of rows to score at once.
+        :return: A list of at most k (image path, similarity score) pairs, best first.
+        """
+        similarity_scores = []
+        with self.segment_store.snapshot() as snapshot:
             try:
-                return sum(1 for _ in file) - 1
+                best = self.similarity_utility.process_top_k_label_matrices(
+                    self.label_matrix_chunks(snapshot, chunk_size), input_labels, k, min_score)
+                similarity_scores = self.resolve_image_paths(snapshot, best)
             except (csv.Error, IOError) as e:
                 print(f"Error: {e}")
+        return similarity_scores
+
+    def label_matrix_chunks(self, snapshot, chunk_size):
+        """
+        Iterate over the label matrices of the original images of a snapshot, chunk by chunk.
+
+        Chunks are expanded from the label masks of the segments, read chunk_size segment rows
+        at a time, so no row text is parsed and memory use does not grow with the index. Rows are
+        keyed by their segment and row numbers, which keeps ties in index order.
+
+        :param snapshot: The Snapshot to read.
+        :param chunk_size: The number of segment rows to read for each chunk.
+        :return: An iterator of (keys, (segment number, row number) items, label matrix) chunks.
+        """
+        for segment_number, segment in enumerate(snapshot.segments):
+            for row_numbers, masks in self.label_index.chunks(snapshot, segment, chunk_size, include_variants=False):
+                if len(row_numbers):
+                    items = [(segment_number, row_number) for row_number in row_numbers.tolist()]
+                    yield (segment_number << 32) + row_numbers, items, label_matrix(masks)
+
+    def resolve_image_paths(self, snapshot, scored_rows):
+        """
+        Replace the (segment number, row number) items of scored rows with their image paths.
+
+        The paths of each segment are read in a single pass, in row order.
+
+        :param snapshot: The Snapshot the rows belong to.
+        :param scored_rows: A list of ((segment number, row number), similarity score) pairs.
+        :return: A list of (image path, similarity score) pairs in the same order.
+        """
+        row_numbers_by_segment = {}
+        for (segment_number, row_number), _ in scored_rows:
+            row_numbers_by_segment.setdefault(segment_number, []).append(row_number)
+        image_paths = {}
+        for segment_number, row_numbers in row_numbers_by_segment.items():
+            row_numbers.sort()
+            segment_paths = snapshot.read_image_paths(snapshot.segments[segment_number], row_numbers)
+            image_paths.update(((segment_number, row_number), image_path)
+                               for row_number, image_path in zip(row_numbers, segment_paths))
+        return [(image_paths[item], similarity) for item, similarity in scored_rows]
+
+    def get_total_num_images(self):
+        """Get the total number of images in the CSV file."""
+        with self.segment_store.snapshot() as snapshot:
+            return snapshot.count_rows()
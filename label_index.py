@@ -0,0 +1,194 @@
+import os
+from collections import namedtuple
+import numpy as np
+from object_detector import LABEL_IDS, LABEL_NAMES
+from segment_store import INDEX_HEADER, ISegmentIndexer, file_stem, load_deleted_rows
+from similarity_utility import DEFAULT_CHUNK_SIZE
+
+# Label sets are stored as 128-bit masks, with bit i set when label id i is present.
+MASK_BYTES = 16
+
+LABELS_SUFFIX = '.labels.npy'
+
+# A labels sidecar is one uint8 array with a row per segment row: the MASK_BYTES bytes of its
+# label mask, then a variant flag.
+VARIANT_FLAG_COLUMN = MASK_BYTES
+
+DETECTED_OBJECTS_COLUMN = INDEX_HEADER.index("Detected_Objects")
+VARIANT_OF_COLUMN = INDEX_HEADER.index("Variant_Of")
+
+def label_mask(labels):
+    """
+    Convert label names to a label mask. Names outside the vocabulary are ignored.
+
+    :param labels: An iterable of label names.
+    :return: The mask as an int.
+    """
+    mask = 0
+    for label in labels:
+        label_id = LABEL_IDS.get(label)
+        if label_id is not None:
+            mask |= 1 << label_id
+    return mask
+
+def all_known_labels(labels):
+    """Return True if every label name is in the vocabulary."""
+    return all(label in LABEL_IDS for label in labels)
+
+def label_names(mask):
+    """
+    Convert a label mask to label names, in vocabulary order.
+
+    :param mask: The mask as an int.
+    :return: A list of label names.
+    """
+    return [label for label_id, label in enumerate(LABEL_NAMES) if mask >> label_id & 1]
+
+def mask_bytes(mask):
+    """Return a label mask as an array of MASK_BYTES bytes, matching the rows of a labels sidecar."""
+    return np.frombuffer(mask.to_bytes(MASK_BYTES, 'little'), dtype=np.uint8)
+
+def label_matrix(masks):
+    """
+    Expand rows of label mask bytes into a 0/1 label matrix, with columns in label id order as in encode_labels.
+
+    :param masks: An array of shape (rows, MASK_BYTES).
+    :return: A uint8 array of shape (rows, number of labels).
+    """
+    return np.unpackbits(masks, axis=1, bitorder='little')[:, :len(LABEL_NAMES)]
+
+def encode_rows(rows):
+    """
+    Encode the label masks and variant flags of rows as rows of a labels sidecar.
+
+    :param rows: An iterable of rows, each a list of values in index header order.
+    :return: A uint8 array of shape (rows, MASK_BYTES + 1).
+    """
+    table = bytearray()
+    for row in rows:
+        table += label_mask(row[DETECTED_OBJECTS_COLUMN].split(",")).to_bytes(MASK_BYTES, 'little')
+        table.append(len(row) > VARIANT_OF_COLUMN and bool(row[VARIANT_OF_COLUMN]))
+    return np.frombuffer(table, dtype=np.uint8).reshape(-1, MASK_BYTES + 1)
+
+def concatenate_chunks(chunks):
+    """Concatenate (row numbers, masks) chunks into a single pair."""
+    row_numbers = [chunk_rows for chunk_rows, _ in chunks]
+    masks = [chunk_masks for _, chunk_masks in chunks]
+    return (np.concatenate(row_numbers) if row_numbers else np.empty(0, dtype=np.int64),
+            np.concatenate(masks) if masks else np.empty((0, MASK_BYTES), dtype=np.uint8))
+
+def labels_path(segment_path):
+    """Return the path of the labels sidecar of a segment."""
+    directory, name = os.path.split(segment_path)
+    return os.path.join(directory, file_stem(name) + LABELS_SUFFIX)
+
+class ImageRecord(namedtuple('ImageRecord', ['image_path', 'label_mask'])):
+    """An image in query results, with its labels as a label mask. Label names are only produced for printing."""
+
+    __slots__ = ()
+
+class LabelIndex(ISegmentIndexer):
+    """
+    Array-backed label masks for every row of each segment.
+
+    Queries over labels read a segment's masks as (rows, MASK_BYTES) arrays and evaluate them
+    vectorised, instead of splitting the Detected_Objects text of every row. Sidecars are
+    memory-mapped and read a chunk of rows at a time, so queries hold no more than one chunk of
+    masks per segment in memory.
+    """
+
+    def build_index(self, segment_path, rows):
+        """
+        Write the labels sidecar of a segment from its Detected_Objects and Variant_Of columns.
+
+        :param segment_path: The path the segment is written to.
+        :param rows: The rows of the segment, each a list of values in index header order.
+        """
+        path = labels_path(segment_path)
+        temp_path = path + '.tmp'
+        with open(temp_path, mode='wb') as file:
+            np.save(file, encode_rows(rows))
+        os.replace(temp_path, path)
+
+    def chunks(self, snapshot, segment, chunk_size=DEFAULT_CHUNK_SIZE, include_variants=True):
+        """
+        Iterate over the label masks of the rows of a segment that have not been deleted.
+
+        The labels sidecar is memory-mapped and read a chunk at a time.
+
+        :param snapshot: The Snapshot the segment belongs to.
+        :param segment: The manifest entry of the segment.
+        :param chunk_size: The number of segment rows to read at once.
+        :param include_variants: If False, rows of near-duplicate variants are skipped too.
+        :return: An iterator of (row numbers, masks) pairs, with masks of shape (rows, MASK_BYTES).
+        """
+        deleted = load_deleted_rows(snapshot.directory, segment)
+        table = np.load(labels_path(snapshot.segment_path(segment)), mmap_mode='r')
+        for start in range(0, len(table), chunk_size):
+            yield self.live_chunk(start, np.asarray(table[start:start + chunk_size]), deleted, include_variants)
+
+    def live_chunk(self, start, table, deleted, include_variants):
+        """
+        Select the live rows of a chunk of a labels sidecar.
+
+        :param start: The row number of the first row of the chunk.
+        :param table: The chunk, an array of shape (rows, MASK_BYTES + 1).
+        :param deleted: The sorted row numbers deleted from the segment.
+        :param include_variants: If False, rows of near-duplicate variants are not selected.
+        :return: A (row numbers, masks) pair.
+        """
+        live = np.ones(len(table), dtype=bool) if include_variants else table[:, VARIANT_FLAG_COLUMN] == 0
+        first, last = np.searchsorted(deleted, [start, start + len(table)])
+        live[np.asarray(deleted[first:last], dtype=np.int64) - start] = False
+        return np.arange(start, start + len(table))[live], table[live, :MASK_BYTES]
+
+    def match_rows(self, snapshot, segment, all, query_mask):
+        """
+        Find the rows of a segment whose labels match a query mask.
+
+        :param snapshot: The Snapshot the segment belongs to.
+        :param segment: The manifest entry of the segment.
+        :param all: If True, rows must have every label of the query. If False, at least one.
+        :param query_mask: The query labels as a mask.
+        :return: A (row numbers, masks) pair of the matching rows, in row order.
+        """
+        query = mask_bytes(query_mask)
+        matches = []
+        for row_numbers, masks in self.chunks(snapshot, segment):
+            common = masks & query
+            matching = (common == query).all(axis=1) if all else common.any(axis=1)
+            matches.append((row_numbers[matching], masks[matching]))
+        return concatenate_chunks(matches)
+
+    def select_rows(self, snapshot, segment, row_numbers=None):
+        """
+        Read the label masks of rows of a segment, skipping deleted rows.
+
+        :param snapshot: The Snapshot the segment belongs to.
+        :param segment: The manifest entry of the segment.
+        :param row_numbers: A sorted array of the row numbers to read, or None for every row.
+        :return: A (row numbers, masks) pair, in row order.
+        """
+        selected = []
+        for chunk_rows, masks in self.chunks(snapshot, segment):
+            if row_numbers is not None:
+                wanted = np.isin(chunk_rows, row_numbers)
+                chunk_rows, masks = chunk_rows[wanted], masks[wanted]
+            selected.append((chunk_rows, masks))
+        return concatenate_chunks(selected)
+
+    def records(self, snapshot, segment, row_numbers, masks):
+        """
+        Build the ImageRecords of rows of a segment, reading only the image path column.
+
+        :param snapshot: The Snapshot the segment belongs to.
+        :param segment: The manifest entry of the segment.
+        :param row_numbers: A sorted array of row numbers.
+        :param masks: The label masks of the rows, an array of shape (rows, MASK_BYTES).
+        :return: A list of ImageRecords in row order.
+        """
+        if not len(row_numbers):
+            return []
+        image_paths = snapshot.read_image_paths(segment, row_numbers)
+        return [ImageRecord(image_path, int.from_bytes(mask.tobytes(), 'little'))
+                for image_path, mask in zip(image_paths, masks)]
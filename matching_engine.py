@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
 from index_access import IndexAccess
+from segment_store import INDEX_DIR
+from similarity_utility import DEFAULT_CHUNK_SIZE
 
 class IMatchingEngine(ABC):
     """Abstract base class for a matching engine."""
@@ -14,6 +16,17 @@ class IMatchingEngine(ABC):
         :return: A list of matching images.
         """
 
+    @abstractmethod
+    def find_images_matching_regions(self, all, term_set, region_query):
+        """
+        Find and return images whose detections of the query terms satisfy a region query.
+
+        :param all: If True, return images matching all query terms. If False, return images matching some query terms.
+        :param term_set: A set of query terms.
+        :param region_query: The RegionQuery a detection of a term must satisfy for the term to match.
+        :return: A list of matching images.
+        """
+
     @abstractmethod
     def get_similar_images(self, input_labels):
         """
@@ -23,12 +36,28 @@ class IMatchingEngine(ABC):
         :return: A list of similar images and their similarity scores.
         """
 
+    @abstractmethod
+    def get_top_k_similar_images(self, input_labels, k, min_score=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Get and return the k most similar images based on input labels.
+
+        :param input_labels: A list of input labels for similarity calculation.
+        :param k: The number of similar images to return.
+        :param min_score: If given, images scoring below this value are left out.
+        :param chunk_size: The number of index rows to score at once.
+        :return: A list of at most k similar images and their similarity scores, best first.
+        """
+
 class MatchingEngine(IMatchingEngine):
     """Implementation of a matching engine."""
 
-    def __init__(self):
-        """Initialize the MatchingEngine object."""
-        self.index_access = IndexAccess()
+    def __init__(self, index_dir=INDEX_DIR):
+        """
+        Initialize the MatchingEngine object.
+
+        :param index_dir: The directory holding the index segments.
+        """
+        self.index_access = IndexAccess(index_dir)
 
     def find_matching_images(self, all, term_set):
         """
@@ -41,6 +70,17 @@ class MatchingEngine(IMatchingEngine):
         matching_images = self.index_access.access_matching_images(all, term_set)
         return matching_images
 
+    def find_images_matching_regions(self, all, term_set, region_query):
+        """
+        Find and return images whose detections of the query terms satisfy a region query.
+
+        :param all: If True, return images matching all query terms. If False, return images matching some query terms.
+        :param term_set: A set of query terms.
+        :param region_query: The RegionQuery a detection of a term must satisfy for the term to match.
+        :return: A list of matching images.
+        """
+        return self.index_access.access_images_matching_regions(all, term_set, region_query)
+
     def get_similar_images(self, input_labels):
         """
         Get and return similar images based on input labels.
@@ -51,3 +91,15 @@ class MatchingEngine(IMatchingEngine):
         similarity_scores = self.index_access.calculate_similarity_scores(input_labels)
         similarity_scores.sort(key=lambda x: x[1], reverse=True)
         return similarity_scores
+
+    def get_top_k_similar_images(self, input_labels, k, min_score=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Get and return the k most similar images based on input labels.
+
+        :param input_labels: A list of input labels for similarity calculation.
+        :param k: The number of similar images to return.
+        :param min_score: If given, images scoring below this value are left out.
+        :param chunk_size: The number of index rows to score at once.
+        :return: A list of at most k similar images and their similarity scores, best first.
+        """
+        return self.index_access.calculate_top_k_similarity_scores(input_labels, k, min_score, chunk_size)
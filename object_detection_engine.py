@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from object_detector import detect_objects
+from object_detector import detect_object_boxes, detect_objects, model_fingerprint
 
 class IObjectDetectionEngine(ABC):
     """Abstract base class for an object detection engine."""
@@ -13,16 +13,38 @@ class IObjectDetectionEngine(ABC):
         :return: A list of detected objects.
         """
 
+    @abstractmethod
+    def use_box_detector(self, image):
+        """
+        Use an object detector to detect objects, with their boxes and scores, in the given image.
+
+        :param image: The image for object detection.
+        :return: A list of (label, score, ymin, xmin, ymax, xmax) detections with normalised box coordinates.
+        """
+
+    @abstractmethod
+    def get_model_fingerprint(self):
+        """
+        Get a fingerprint identifying the engine and model that produce its detections.
+
+        :return: The fingerprint as a string.
+        """
+
 class DefaultObjectDetectionEngine(IObjectDetectionEngine):
     """Default implementation of an object detection engine."""
 
-    def __init__(self, detect_objects):
+    def __init__(self, detect_objects, detect_object_boxes=None, model_fingerprint=None):
         """
         Initialise the DefaultObjectDetectionEngine with a detect_objects function.
 
         :param detect_objects: A function for object detection.
+        :param detect_object_boxes: A function for object detection that also returns boxes and scores.
+        :param model_fingerprint: A function returning a fingerprint of the detection model.
         """
         self.detect_objects = detect_objects
+        self.detect_object_boxes = detect_object_boxes
+        self.model_fingerprint = model_fingerprint
+        self.fingerprint = None
 
     def use_object_detector(self, image):
         """
@@ -37,6 +59,35 @@ class DefaultObjectDetectionEngine(IObjectDetectionEngine):
             print(f"Error in object detection: {e}")
             return []
 
+    def use_box_detector(self, image):
+        """
+        Use the object detector to detect objects, with their boxes and scores, in the given image.
+
+        :param image: The image for object detection.
+        :return: A list of (label, score, ymin, xmin, ymax, xmax) detections with normalised box coordinates.
+        """
+        if self.detect_object_boxes is None:
+            return []
+        try:
+            return self.detect_object_boxes(image)
+        except Exception as e:
+            print(f"Error in object detection: {e}")
+            return []
+
+    def get_model_fingerprint(self):
+        """
+        Get a fingerprint identifying the engine and model that produce its detections.
+
+        The model fingerprint is computed once per engine.
+
+        :return: The fingerprint as a string.
+        """
+        if self.fingerprint is None:
+            self.fingerprint = 'default'
+            if self.model_fingerprint is not None:
+                self.fingerprint += f":{self.model_fingerprint()}"
+        return self.fingerprint
+
 class CustomObjectDetectionEngine(IObjectDetectionEngine):
     """Custom implementation of an object detection engine."""
 
@@ -48,6 +99,22 @@ class CustomObjectDetectionEngine(IObjectDetectionEngine):
         :return: A list of detected objects (not implemented in this class).
         """
 
+    def use_box_detector(self, image):
+        """
+        Use a custom object detector to detect objects, with their boxes and scores, in the given image.
+
+        :param image: The image for object detection.
+        :return: A list of detections (not implemented in this class).
+        """
+
+    def get_model_fingerprint(self):
+        """
+        Get a fingerprint identifying the engine and model that produce its detections.
+
+        :return: The fingerprint as a string.
+        """
+        return 'custom'
+
 class ObjectDetectionEngineFactory:
     """Factory for creating object detection engines."""
 
@@ -60,7 +127,7 @@ class ObjectDetectionEngineFactory:
         :raises ValueError: If an invalid object detection engine type is provided.
         """
         if engine_type == 'default':
-            return DefaultObjectDetectionEngine(detect_objects)
+            return DefaultObjectDetectionEngine(detect_objects, detect_object_boxes, model_fingerprint)
         elif engine_type == 'custom':
             return CustomObjectDetectionEngine()
         else:
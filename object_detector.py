@@ -1,4 +1,5 @@
 import os
+import hashlib
 import numpy as np
 os.environ['TF_CPP_MIN_LOG_LEVEL']='2'
 import tensorflow as tf
@@ -88,19 +89,42 @@ ALL_LABELS = {
  89: 'hair drier',
  90: 'toothbrush'}
 
+# The canonical label vocabulary: every label has a dense id, its position in LABEL_NAMES.
+LABEL_NAMES = tuple(ALL_LABELS.values())
+LABEL_IDS = {label: label_id for label_id, label in enumerate(LABEL_NAMES)}
+
 DETECTION_MODEL_DIR='detection_model'
 
 def encode_labels(labels):
     """Returns a list of booleans (0/1) indicating the object types present in `labels`"""
-    return [1 if label in labels else 0 for label in ALL_LABELS.values()]
+    vector = [0] * len(LABEL_NAMES)
+    for label in labels:
+        label_id = LABEL_IDS.get(label)
+        if label_id is not None:
+            vector[label_id] = 1
+    return vector
+
+def model_fingerprint():
+    """Returns a short hash of the files in DETECTION_MODEL_DIR, identifying the detection model"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(DETECTION_MODEL_DIR):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, DETECTION_MODEL_DIR).encode())
+            with open(path, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.hexdigest()[:16]
 
 def load_model():
     """Loads the detection model from directory DETECTION_MODEL_DIR"""
     model = tf.saved_model.load(DETECTION_MODEL_DIR)    
     return model.signatures['serving_default']
 
-def detect_objects(image):
-    """Detects objects in image and returns the set of labels for the objects"""
+def detect_object_boxes(image):
+    """Detects objects in image and returns a list of (label, score, ymin, xmin, ymax, xmax) detections,
+    with box coordinates normalised to [0, 1]"""
     model = load_model()
 
     image = np.asarray(image)
@@ -111,6 +135,12 @@ def detect_objects(image):
 
     num_detections = int(output_dict['num_detections'])
     detected_classes = output_dict['detection_classes'][0,:num_detections].numpy().astype(int)
+    detected_scores = output_dict['detection_scores'][0,:num_detections].numpy()
+    detected_boxes = output_dict['detection_boxes'][0,:num_detections].numpy()
 
-    labels = set(ALL_LABELS[cls] for cls in detected_classes)
-    return labels
+    return [(ALL_LABELS[cls], float(score), *(float(coordinate) for coordinate in box))
+            for cls, score, box in zip(detected_classes, detected_scores, detected_boxes)]
+
+def detect_objects(image):
+    """Detects objects in image and returns the set of labels for the objects"""
+    return set(label for label, *_ in detect_object_boxes(image))
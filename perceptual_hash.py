@@ -0,0 +1,196 @@
+import os
+from array import array
+from abc import ABC, abstractmethod
+import numpy as np
+from PIL import Image
+from segment_store import INDEX_HEADER, ISegmentIndexer, file_stem, read_deleted_rows
+
+# Images are reduced to HASH_IMAGE_SIZE x HASH_IMAGE_SIZE greyscale pixels, and the lowest
+# HASH_SIZE x HASH_SIZE DCT coefficients give the 64 bits of the hash.
+HASH_IMAGE_SIZE = 32
+HASH_SIZE = 8
+
+# Hashes within this Hamming distance are treated as near-duplicates.
+DUPLICATE_MAX_DISTANCE = 6
+
+# The 64-bit hash is split into HASH_SEGMENTS substrings of HASH_SEGMENT_BITS bits, each indexed
+# separately. Two hashes within distance r differ by at most r // HASH_SEGMENTS bits in at least
+# one substring, so probing every substring within that radius finds every match.
+HASH_SEGMENTS = 4
+HASH_SEGMENT_BITS = 64 // HASH_SEGMENTS
+
+HASHES_SUFFIX = '.phash.npy'
+
+# A hash sidecar is one uint64 array of shape (TABLE_ROWS, number of hashes): the hashes, their
+# row numbers, then for each substring the hash positions sorted by it, then the sorted substrings.
+HASHES_ROW = 0
+ROW_NUMBERS_ROW = 1
+ORDER_ROWS = 2
+KEYS_ROWS = ORDER_ROWS + HASH_SEGMENTS
+TABLE_ROWS = KEYS_ROWS + HASH_SEGMENTS
+
+PERCEPTUAL_HASH_COLUMN = INDEX_HEADER.index("Perceptual_Hash")
+
+def dct_matrix(size):
+    """Return the orthonormal DCT-II matrix of a size."""
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[np.newaxis, :] + 1) * n[:, np.newaxis] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+DCT_MATRIX = dct_matrix(HASH_IMAGE_SIZE)
+
+def hamming_distances(hashes, perceptual_hash):
+    """
+    Compute the Hamming distances between an array of 64-bit hashes and one hash.
+
+    :param hashes: An array of hashes as uint64.
+    :param perceptual_hash: The hash to compare with, as an int.
+    :return: An array of distances.
+    """
+    differences = np.asarray(hashes, dtype=np.uint64) ^ np.uint64(perceptual_hash)
+    return np.unpackbits(differences.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+def hash_segment(hashes, segment):
+    """Return one HASH_SEGMENT_BITS-bit substring of 64-bit hashes."""
+    shift = np.uint64(segment * HASH_SEGMENT_BITS)
+    return (np.asarray(hashes, dtype=np.uint64) >> shift) & np.uint64((1 << HASH_SEGMENT_BITS) - 1)
+
+def substrings_within(value, radius):
+    """Return every HASH_SEGMENT_BITS-bit value within a Hamming radius of a value."""
+    values = [value]
+    for _ in range(radius):
+        values = list({neighbour ^ (1 << bit) for neighbour in values for bit in range(HASH_SEGMENT_BITS)} | set(values))
+    return values
+
+def hash_table(rows):
+    """
+    Build the hash table of a segment from its Perceptual_Hash column.
+
+    :param rows: An iterable of the rows of the segment, each a list of values in index header order.
+    :return: A uint64 array of shape (TABLE_ROWS, number of rows with a hash).
+    """
+    row_numbers, hashes = array('Q'), array('Q')
+    for row_number, row in enumerate(rows):
+        if len(row) > PERCEPTUAL_HASH_COLUMN and row[PERCEPTUAL_HASH_COLUMN]:
+            row_numbers.append(row_number)
+            hashes.append(int(row[PERCEPTUAL_HASH_COLUMN], 16))
+    table = np.empty((TABLE_ROWS, len(hashes)), dtype=np.uint64)
+    table[HASHES_ROW] = np.frombuffer(hashes, dtype=np.uint64)
+    table[ROW_NUMBERS_ROW] = np.frombuffer(row_numbers, dtype=np.uint64)
+    for segment in range(HASH_SEGMENTS):
+        order = np.argsort(hash_segment(table[HASHES_ROW], segment), kind='stable')
+        table[ORDER_ROWS + segment] = order
+        table[KEYS_ROWS + segment] = hash_segment(table[HASHES_ROW][order], segment)
+    return table
+
+def hashes_path(segment_path):
+    """Return the path of the perceptual hash sidecar of a segment."""
+    directory, name = os.path.split(segment_path)
+    return os.path.join(directory, file_stem(name) + HASHES_SUFFIX)
+
+class IPerceptualHasher(ABC):
+    """Abstract base class for computing perceptual hashes of images."""
+
+    @abstractmethod
+    def hash_image(self, image_path):
+        """
+        Compute the perceptual hash of an image.
+
+        :param image_path: The path to the image file.
+        :return: The hash as a 64-bit int, or None if the image cannot be read.
+        """
+
+class DctPerceptualHasher(IPerceptualHasher):
+    """Perceptual hasher comparing low-frequency DCT coefficients of a small greyscale image to their median."""
+
+    def hash_image(self, image_path):
+        """
+        Compute the perceptual hash of an image.
+
+        JPEG images are decoded at a reduced scale, which is much cheaper than a full decode.
+
+        :param image_path: The path to the image file.
+        :return: The hash as a 64-bit int, or None if the image cannot be read.
+        """
+        try:
+            with Image.open(image_path) as image:
+                image.draft('L', (HASH_IMAGE_SIZE * 4, HASH_IMAGE_SIZE * 4))
+                pixels = np.asarray(image.convert('L').resize((HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), Image.BILINEAR),
+                                    dtype=np.float64)
+        except Exception as e:
+            print(f"Error in perceptual hashing: {e}")
+            return None
+        coefficients = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE]
+        bits = coefficients > np.median(coefficients)
+        return int.from_bytes(np.packbits(bits.flatten()).tobytes(), 'big')
+
+class MultiIndexHashIndex(ISegmentIndexer):
+    """
+    Multi-index hashing over each segment's perceptual hashes.
+
+    For every segment a sidecar holds the hashes with their row numbers, and for each of the
+    HASH_SEGMENTS substrings the hash positions and substring values sorted by that substring.
+    Sidecars are memory-mapped, so a lookup binary-searches a few substring values per table and
+    reads only the pages it touches instead of comparing against, or even loading, every hash.
+    """
+
+    def build_index(self, segment_path, rows):
+        """
+        Write the perceptual hash sidecar of a segment from its Perceptual_Hash column.
+
+        :param segment_path: The path the segment is written to.
+        :param rows: The rows of the segment, each a list of values in index header order.
+        """
+        table = hash_table(rows)
+        path = hashes_path(segment_path)
+        temp_path = path + '.tmp'
+        with open(temp_path, mode='wb') as file:
+            np.save(file, table)
+        os.replace(temp_path, path)
+
+    def find_near_duplicates(self, snapshot, perceptual_hash, max_distance=DUPLICATE_MAX_DISTANCE):
+        """
+        Find the rows of a snapshot whose perceptual hash is within a Hamming distance of a hash.
+
+        :param snapshot: The Snapshot to search.
+        :param perceptual_hash: The hash to look up, as an int.
+        :param max_distance: The largest Hamming distance that counts as a near-duplicate.
+        :return: A list of (distance, segment, row number) matches, closest first.
+        """
+        matches = []
+        for segment in snapshot.segments:
+            table = self.load_table(snapshot.segment_path(segment))
+            if not table.shape[1]:
+                continue
+            candidates = set()
+            for hash_segment_number in range(HASH_SEGMENTS):
+                keys = table[KEYS_ROWS + hash_segment_number]
+                order = table[ORDER_ROWS + hash_segment_number]
+                query = int(hash_segment(perceptual_hash, hash_segment_number))
+                for value in substrings_within(query, max_distance // HASH_SEGMENTS):
+                    start = np.searchsorted(keys, np.uint64(value), side='left')
+                    end = np.searchsorted(keys, np.uint64(value), side='right')
+                    candidates.update(order[start:end].tolist())
+            if not candidates:
+                continue
+            candidates = np.array(sorted(candidates))
+            distances = hamming_distances(table[HASHES_ROW][candidates], perceptual_hash)
+            deleted = read_deleted_rows(snapshot.directory, segment)
+            for position, distance in zip(candidates[distances <= max_distance], distances[distances <= max_distance]):
+                row_number = int(table[ROW_NUMBERS_ROW][position])
+                if row_number not in deleted:
+                    matches.append((int(distance), segment, row_number))
+        return sorted(matches, key=lambda match: match[0])
+
+    def load_table(self, segment_path):
+        """
+        Open the hash table of a segment.
+
+        The sidecar is memory-mapped rather than read. Every segment is written with one, so a
+        missing sidecar raises FileNotFoundError.
+
+        :param segment_path: The path of the segment.
+        :return: A uint64 array of shape (TABLE_ROWS, number of hashes).
+        """
+        return np.load(hashes_path(segment_path), mmap_mode='r')
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from index_access import *
+from label_index import label_names
 
 class IPrintingEngine(ABC):
     """Abstract base class for a printing engine."""
@@ -12,12 +13,21 @@ class IPrintingEngine(ABC):
         :param detected_objects: A list of detected objects.
         """
 
+    @abstractmethod
+    def print_near_duplicate(self, image_path, original_path):
+        """
+        Print that an image was linked to a near-duplicate instead of running detection.
+
+        :param image_path: The path of the ingested image.
+        :param original_path: The path of the image whose labels it reuses.
+        """
+
     @abstractmethod
     def print_image_data(self, image_data):
         """
         Print image data, including detected objects.
 
-        :param image_data: A list of image data, each containing image path and detected objects.
+        :param image_data: A list of ImageRecords, each containing image path and label mask.
         """
 
     @abstractmethod
@@ -25,7 +35,7 @@ class IPrintingEngine(ABC):
         """
         Print matching images and their detected objects.
 
-        :param matching_images: A list of matching images with detected objects.
+        :param matching_images: A list of ImageRecords of the matching images.
         """
 
     @abstractmethod
@@ -38,6 +48,35 @@ class IPrintingEngine(ABC):
         :param k: The number of similar images to print.
         """
 
+    @abstractmethod
+    def print_redetect_progress(self, completed, total):
+        """
+        Print the progress of re-detecting stale images.
+
+        :param completed: The number of images re-detected so far in this run.
+        :param total: The number of images to re-detect in this run.
+        """
+
+    @abstractmethod
+    def print_redetect_summary(self, completed, failed):
+        """
+        Print the outcome of re-detecting stale images.
+
+        :param completed: The number of images re-detected in this run.
+        :param failed: The number of images that could not be read, in this or earlier runs.
+        """
+
+    @abstractmethod
+    def print_sync_report(self, added, changed, removed, failed):
+        """
+        Print the changes applied to the index by a directory sync.
+
+        :param added: Paths of image files that were added.
+        :param changed: Paths of image files that were re-ingested because their content changed.
+        :param removed: Paths of image files that were removed from the index.
+        :param failed: Paths of image files that could not be read.
+        """
+
     @abstractmethod
     def print_total_num_images(self):
         """
@@ -47,8 +86,8 @@ class IPrintingEngine(ABC):
 class PrintingEngine(IPrintingEngine):
     """Implementation of a printing engine."""
 
-    def __init__(self):
-        self.index_access = IndexAccess()
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_access = IndexAccess(index_dir)
 
     def print_detection_results(self, detected_objects):
         """
@@ -59,21 +98,32 @@ class PrintingEngine(IPrintingEngine):
         detected_objects_str = ",".join(detected_objects)
         print(f"Detected objects: {detected_objects_str}")
 
+    def print_near_duplicate(self, image_path, original_path):
+        """
+        Print that an image was linked to a near-duplicate instead of running detection.
+
+        :param image_path: The path of the ingested image.
+        :param original_path: The path of the image whose labels it reuses.
+        """
+        print(f"{image_path} is a near-duplicate of {original_path}")
+
     def print_image_data(self, image_data):
         """
         Print image data, including detected objects.
 
-        :param image_data: A list of image data, each containing image path and detected objects.
+        Label masks are converted to label names here, as late as possible.
+
+        :param image_data: A list of ImageRecords, each containing image path and label mask.
         """
-        for image_path, detected_objects in image_data:
-            detected_objects_str = ",".join(detected_objects)
+        for image_path, mask in image_data:
+            detected_objects_str = ",".join(label_names(mask))
             print(f"{image_path}: {detected_objects_str}")
 
     def print_matching_images(self, matching_images):
         """
         Print matching images and their detected objects.
 
-        :param matching_images: A list of matching images with detected objects.
+        :param matching_images: A list of ImageRecords of the matching images.
         """
         self.print_image_data(matching_images)
         print(f"{len(matching_images)} matches found.")
@@ -89,6 +139,41 @@ class PrintingEngine(IPrintingEngine):
         for image_path, similarity in similarity_scores[:k]:
             print(f"{similarity:.4f} {image_path}")
 
+    def print_redetect_progress(self, completed, total):
+        """
+        Print the progress of re-detecting stale images.
+
+        :param completed: The number of images re-detected so far in this run.
+        :param total: The number of images to re-detect in this run.
+        """
+        print(f"Re-detected {completed}/{total} images.")
+
+    def print_redetect_summary(self, completed, failed):
+        """
+        Print the outcome of re-detecting stale images.
+
+        :param completed: The number of images re-detected in this run.
+        :param failed: The number of images that could not be read, in this or earlier runs.
+        """
+        print(f"{completed} images re-detected, {failed} images could not be read.")
+
+    def print_sync_report(self, added, changed, removed, failed):
+        """
+        Print the changes applied to the index by a directory sync.
+
+        :param added: Paths of image files that were added.
+        :param changed: Paths of image files that were re-ingested because their content changed.
+        :param removed: Paths of image files that were removed from the index.
+        :param failed: Paths of image files that could not be read.
+        """
+        failed_set = set(failed)
+        for status, image_paths in (("added", added), ("changed", changed), ("removed", removed), ("failed", failed)):
+            for image_path in image_paths:
+                if status == "failed" or image_path not in failed_set:
+                    print(f"{status}: {image_path}")
+        print(f"{len(set(added) - failed_set)} added, {len(set(changed) - failed_set)} changed, "
+              f"{len(removed)} removed, {len(failed)} failed.")
+
     def print_total_num_images(self):
         """Print the total number of images in the dataset."""
         total_images = self.index_access.get_total_num_images()
@@ -0,0 +1,676 @@
+import os
+import io
+import itertools
+import csv
+import fcntl
+import json
+import time
+import uuid
+from array import array
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import numpy as np
+
+INDEX_DIR = 'image_index'
+INDEX_HEADER = ["Image_Path", "Detected_Objects", "Detections", "Model_Fingerprint", "Perceptual_Hash", "Variant_Of"]
+
+CURRENT_FILE = 'CURRENT'
+LOCK_FILE = 'write.lock'
+MERGE_LOCK_FILE = 'merge.lock'
+MERGING_PREFIX = 'merging-'
+PINS_DIR = 'pins'
+DELETED_MARKER = '.deleted-'
+OFFSETS_SUFFIX = '.offsets.npy'
+
+# Rows are read by seeking to their offsets when fewer than 1 in SEEK_RATIO rows of a segment
+# are wanted, and by one sequential pass over the segment otherwise.
+SEEK_RATIO = 16
+
+# Seconds a writer waits for another writer before giving up, and the age after which a
+# pin left behind by a crashed process is ignored. Locks are released by the operating
+# system when the process holding them exits.
+LOCK_TIMEOUT = 30
+STALE_PIN_SECONDS = 3600
+
+class LockTimeoutError(Exception):
+    """Raised when a writer gives up waiting for the index writer lock."""
+
+def manifest_name(generation):
+    """Return the file name of the manifest for a generation."""
+    return f"manifest-{generation:08d}.json"
+
+def segment_name(segment_id):
+    """Return the file name of a segment."""
+    return f"segment-{segment_id:08d}.csv"
+
+def deleted_rows_name(segment, generation):
+    """Return the file name of the deletion vector of a segment as of a generation."""
+    return f"{file_stem(segment['name'])}{DELETED_MARKER}{generation:08d}.npy"
+
+def file_stem(name):
+    """Return a segment or manifest file name without its extensions, shared with its sidecar files."""
+    return name.split(".", 1)[0]
+
+def live_rows(segment):
+    """Return the number of rows of a segment that have not been deleted."""
+    return segment["rows"] - segment.get("deleted_rows", 0)
+
+def read_deleted_rows(directory, segment):
+    """Return the set of row numbers deleted from a segment."""
+    if "deleted" not in segment:
+        return frozenset()
+    return frozenset(np.load(os.path.join(directory, segment["deleted"])).tolist())
+
+def load_deleted_rows(directory, segment):
+    """Return the row numbers deleted from a segment as a sorted, memory-mapped array."""
+    if "deleted" not in segment:
+        return np.empty(0, dtype=np.uint32)
+    return np.load(os.path.join(directory, segment["deleted"]), mmap_mode='r')
+
+def read_segment_rows(directory, segment):
+    """
+    Iterate over the rows of a segment that have not been deleted.
+
+    :param directory: The index directory containing the segment files.
+    :param segment: The manifest entry of the segment.
+    :return: An iterator of (row number, row) pairs, with rows as dictionaries keyed by the index header.
+    """
+    deleted = read_deleted_rows(directory, segment)
+    with open(os.path.join(directory, segment["name"]), mode='r', newline='', encoding='utf-8') as file:
+        for row_number, row in enumerate(csv.DictReader(file)):
+            if row_number not in deleted:
+                yield row_number, row
+
+class ISegmentIndexer(ABC):
+    """Abstract base class for a builder of derived sidecar files written alongside each segment."""
+
+    @abstractmethod
+    def build_index(self, segment_path, rows):
+        """
+        Build the sidecar files for a segment before it is published.
+
+        :param segment_path: The path the segment is written to. Sidecars share its stem.
+        :param rows: An iterable of the rows of the segment, each a list of values in index header order,
+            which can only be read once.
+        """
+
+class Snapshot:
+    """A pinned, read-only view of the index as of one generation."""
+
+    def __init__(self, directory, manifest):
+        """
+        Initialise the snapshot from a manifest.
+
+        :param directory: The index directory containing the segment files.
+        :param manifest: The manifest of the pinned generation.
+        """
+        self.directory = directory
+        self.generation = manifest["generation"]
+        self.segments = manifest["segments"]
+
+    def rows(self):
+        """
+        Iterate over every row in the snapshot, one segment file at a time.
+
+        :return: An iterator of rows as dictionaries keyed by the index header.
+        """
+        for segment in self.segments:
+            for _, row in self.segment_rows(segment):
+                yield row
+
+    def segment_rows(self, segment):
+        """
+        Iterate over the rows of one segment of the snapshot, skipping deleted rows.
+
+        :param segment: The manifest entry of the segment.
+        :return: An iterator of (row number, row) pairs, with rows as dictionaries keyed by the index header.
+        """
+        return read_segment_rows(self.directory, segment)
+
+    def read_row(self, segment, row_number):
+        """
+        Read a single row of a segment of the snapshot by seeking to its byte offset.
+
+        :param segment: The manifest entry of the segment.
+        :param row_number: The number of the row within the segment.
+        :return: The row as a dictionary keyed by the index header, or None if it was deleted.
+        """
+        if row_number in read_deleted_rows(self.directory, segment):
+            return None
+        offsets = self.read_offsets(segment)
+        if offsets is None:
+            return next((row for number, row in self.segment_rows(segment) if number == row_number), None)
+        with open(self.segment_path(segment), mode='rb') as file:
+            header, row = (self._read_raw_row(file, offsets, number) for number in (-1, row_number))
+        return dict(zip(header, row))
+
+    def read_image_paths(self, segment, row_numbers):
+        """
+        Read the image paths of rows of a segment, without building a dictionary per row.
+
+        :param segment: The manifest entry of the segment.
+        :param row_numbers: A sorted sequence of row numbers.
+        :return: A list of image paths in row order.
+        """
+        row_numbers = [int(row_number) for row_number in row_numbers]
+        offsets = self.read_offsets(segment)
+        if offsets is not None and len(row_numbers) * SEEK_RATIO < segment["rows"]:
+            with open(self.segment_path(segment), mode='rb') as file:
+                return [self._read_raw_row(file, offsets, row_number)[0] for row_number in row_numbers]
+        image_paths = []
+        wanted = iter(row_numbers)
+        next_wanted = next(wanted, None)
+        with open(self.segment_path(segment), mode='r', newline='', encoding='utf-8') as file:
+            reader = csv.reader(file)
+            next(reader)
+            for row_number, row in enumerate(reader):
+                if next_wanted is None:
+                    break
+                if row_number == next_wanted:
+                    image_paths.append(row[0])
+                    next_wanted = next(wanted, None)
+        return image_paths
+
+    def read_offsets(self, segment):
+        """Return the byte offsets of the header and rows of a segment, or None for segments written without them."""
+        offsets_path = os.path.join(self.directory, file_stem(segment["name"]) + OFFSETS_SUFFIX)
+        if not os.path.exists(offsets_path):
+            return None
+        return np.load(offsets_path, mmap_mode='r')
+
+    def _read_raw_row(self, file, offsets, row_number):
+        """Read one row, or the header for row number -1, from an open segment file as a list of values."""
+        file.seek(int(offsets[row_number + 1]))
+        data = file.read(int(offsets[row_number + 2] - offsets[row_number + 1])).decode('utf-8')
+        return next(csv.reader(io.StringIO(data, newline='')))
+
+    def segment_path(self, segment):
+        """Return the path of a segment of the snapshot."""
+        return os.path.join(self.directory, segment["name"])
+
+    def count_rows(self):
+        """Return the number of rows in the snapshot without reading any segment."""
+        return sum(live_rows(segment) for segment in self.segments)
+
+class ISegmentStore(ABC):
+    """Abstract base class for a store of immutable index segments."""
+
+    @abstractmethod
+    def setup(self):
+        """Create an empty store if one does not exist yet."""
+
+    @abstractmethod
+    def snapshot(self):
+        """
+        Pin the current generation for the duration of a read.
+
+        :return: A context manager yielding a Snapshot.
+        """
+
+    @abstractmethod
+    def publish(self, rows, deleted_paths=()):
+        """
+        Append and delete rows by atomically publishing a new generation.
+
+        :param rows: A list of rows, each a list of values in index header order.
+        :param deleted_paths: Image paths whose existing rows are deleted.
+        """
+
+    @abstractmethod
+    def replace(self, rows):
+        """
+        Replace the existing rows of the image paths of the given rows in a new generation.
+
+        :param rows: A list of rows, each a list of values in index header order.
+        """
+
+    @abstractmethod
+    def collect_garbage(self, timeout):
+        """
+        Delete segments and manifests that no current or pinned generation refers to.
+
+        :param timeout: Seconds to wait for other writers before giving up.
+        """
+
+    @abstractmethod
+    def merge_segments(self):
+        """Merge small segments and compact segments with many deleted rows in new generations."""
+
+class SegmentStore(ISegmentStore):
+    """
+    Store of immutable CSV segments with an atomically swapped manifest.
+
+    Each write produces a new generation: new segment files are written in full, then a new
+    manifest listing them is written, then the CURRENT pointer is replaced with os.replace.
+    Readers pin the generation named by CURRENT and only ever open files of that generation,
+    so they neither wait for nor observe in-flight writes.
+    """
+
+    def __init__(self, directory=INDEX_DIR, indexers=()):
+        """
+        Initialise the SegmentStore.
+
+        :param directory: The directory holding the segments, manifests and pins.
+        :param indexers: Segment indexers that build sidecar files for every new segment.
+        """
+        self.directory = directory
+        self.indexers = list(indexers)
+        self.pins_dir = os.path.join(directory, PINS_DIR)
+        self.lock_path = os.path.join(directory, LOCK_FILE)
+        self.current_path = os.path.join(directory, CURRENT_FILE)
+        self._path_hashes_by_segment = {}
+
+    def setup(self):
+        """Create an empty store at generation 0 if one does not exist yet."""
+        os.makedirs(self.pins_dir, exist_ok=True)
+        if os.path.exists(self.current_path):
+            return
+        with self._writer_lock():
+            if not os.path.exists(self.current_path):
+                self._write_manifest({"generation": 0, "next_segment_id": 1, "segments": []})
+
+    def exists(self):
+        """Return True if the store has been set up."""
+        return os.path.exists(self.current_path)
+
+    def read_state(self, name):
+        """
+        Read a JSON state file kept in the index directory outside of any generation.
+
+        :param name: The file name of the state file.
+        :return: The decoded state, or None if the file does not exist.
+        """
+        try:
+            with open(os.path.join(self.directory, name), mode='r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def write_state(self, name, state):
+        """
+        Atomically replace a JSON state file kept in the index directory outside of any generation.
+
+        :param name: The file name of the state file.
+        :param state: The state to encode.
+        """
+        self._write_atomically(name, json.dumps(state))
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Pin the current generation for the duration of a read.
+
+        The pin is taken before the manifest is opened and CURRENT is checked again afterwards,
+        so a writer garbage collecting concurrently either sees the pin or has already moved
+        CURRENT on, in which case the read retries against the newer generation.
+
+        :return: A context manager yielding a Snapshot.
+        """
+        while True:
+            generation = self._read_current()
+            pin_path = os.path.join(self.pins_dir, f"{generation:08d}-{os.getpid()}-{uuid.uuid4().hex}.pin")
+            with open(pin_path, mode='w'):
+                pass
+            if self._read_current() == generation:
+                break
+            os.remove(pin_path)
+        try:
+            yield Snapshot(self.directory, self._read_manifest(generation))
+        finally:
+            os.remove(pin_path)
+        if self._read_current() != generation:
+            try:
+                self.collect_garbage(timeout=0)
+            except LockTimeoutError:
+                pass
+
+    def publish(self, rows, deleted_paths=()):
+        """
+        Append and delete rows by atomically publishing a new generation.
+
+        Appended rows go to a new segment. Deleted rows are recorded in a new deletion vector for
+        each segment they are in, so existing segment files are never rewritten just to delete a
+        few rows. Segments are then merged and compacted by merge_segments, which holds the writer
+        lock only to swap merged segments in.
+
+        :param rows: A list of rows, each a list of values in index header order.
+        :param deleted_paths: Image paths whose existing rows are deleted.
+        """
+        self._commit(rows, deleted_paths, replace_only=False)
+
+    def replace(self, rows):
+        """
+        Replace the existing rows of the image paths of the given rows in a new generation.
+
+        Rows whose image path is no longer in the index, for example because it was deleted
+        while the replacement was being prepared, are dropped rather than added back.
+
+        :param rows: A list of rows, each a list of values in index header order.
+        """
+        self._commit(rows, [row[0] for row in rows], replace_only=True)
+
+    def _commit(self, rows, deleted_paths, replace_only):
+        """Publish a generation appending and deleting rows, then merge segments outside the writer lock."""
+        if not rows and not deleted_paths:
+            return
+        with self._writer_lock():
+            manifest = self._read_manifest(self._read_current())
+            generation = manifest["generation"] + 1
+            next_segment_id = manifest["next_segment_id"]
+            deleted_hashes = np.array([hash(path) for path in set(deleted_paths)], dtype=np.int64)
+            found_hashes = set()
+            segments = []
+            for segment in manifest["segments"]:
+                if deleted_hashes.size:
+                    segment = self._delete_rows(segment, deleted_hashes, generation, found_hashes)
+                if live_rows(segment) > 0:
+                    segments.append(segment)
+            if replace_only:
+                rows = [row for row in rows if hash(row[0]) in found_hashes]
+            if rows:
+                segments.append(self._write_segment(segment_name(next_segment_id), rows))
+                next_segment_id += 1
+            if not rows and not found_hashes:
+                return
+            self._write_manifest({
+                "generation": generation,
+                "next_segment_id": next_segment_id,
+                "segments": segments,
+            })
+            self._collect_garbage()
+        self.merge_segments()
+
+    def merge_segments(self):
+        """
+        Merge small trailing segments and compact segments with many deleted rows.
+
+        Trailing segments are merged while the older one has no more live rows than all newer
+        ones together, which keeps the number of segments logarithmic in the number of rows, and
+        segments with at least half of their rows deleted are compacted. Each merged segment is
+        written without holding the writer lock, so a large merge never makes other writers wait;
+        the lock is only taken to swap it in, and the merge is dropped if its source segments
+        changed in the meantime. Only one process merges at a time; others return immediately.
+        """
+        with self._file_lock(MERGE_LOCK_FILE, timeout=0) as locked:
+            if not locked:
+                return
+            for name in os.listdir(self.directory):
+                if name.startswith(MERGING_PREFIX):
+                    os.remove(os.path.join(self.directory, name))
+            while True:
+                manifest = self._read_manifest(self._read_current())
+                sources = self._plan_merge(manifest["segments"])
+                if not sources:
+                    return
+                merged = self._merge_segments(sources)
+                if not self._swap_in_merged_segment(sources, merged):
+                    self._remove_segment_files(merged["name"])
+
+    def _plan_merge(self, segments):
+        """
+        Choose the segments to merge next.
+
+        :param segments: The manifest entries of the current segments.
+        :return: A list of consecutive manifest entries to merge into one segment, or an empty list.
+        """
+        for segment in segments:
+            if 2 * segment.get("deleted_rows", 0) >= segment["rows"]:
+                return [segment]
+        start = len(segments) - 1
+        merged_rows = live_rows(segments[start]) if segments else 0
+        while start > 0 and live_rows(segments[start - 1]) <= merged_rows:
+            start -= 1
+            merged_rows += live_rows(segments[start])
+        return segments[start:] if len(segments) - start > 1 else []
+
+    def _swap_in_merged_segment(self, sources, merged):
+        """
+        Publish a generation in which a merged segment replaces its source segments.
+
+        :param sources: The manifest entries the merged segment was built from.
+        :param merged: The manifest entry of the merged segment, still under its temporary name.
+        :return: False if the source segments are no longer current, in which case nothing is published.
+        """
+        with self._writer_lock():
+            manifest = self._read_manifest(self._read_current())
+            segments = manifest["segments"]
+            names = [segment["name"] for segment in segments]
+            if sources[0]["name"] not in names:
+                return False
+            start = names.index(sources[0]["name"])
+            if segments[start:start + len(sources)] != sources:
+                return False
+            name = segment_name(manifest["next_segment_id"])
+            stem = file_stem(merged["name"])
+            for file_name in os.listdir(self.directory):
+                if file_stem(file_name) == stem:
+                    os.replace(os.path.join(self.directory, file_name),
+                               os.path.join(self.directory, file_stem(name) + file_name[len(stem):]))
+            segments[start:start + len(sources)] = [dict(merged, name=name)]
+            self._write_manifest({
+                "generation": manifest["generation"] + 1,
+                "next_segment_id": manifest["next_segment_id"] + 1,
+                "segments": segments,
+            })
+            self._collect_garbage()
+        return True
+
+    def _remove_segment_files(self, name):
+        """Delete a segment file that was never published, together with its sidecar files."""
+        stem = file_stem(name)
+        for file_name in os.listdir(self.directory):
+            if file_stem(file_name) == stem:
+                os.remove(os.path.join(self.directory, file_name))
+
+    def _delete_rows(self, segment, deleted_hashes, generation, found_hashes):
+        """
+        Mark the rows of a segment whose image path hash is in deleted_hashes as deleted.
+
+        :param segment: The manifest entry of the segment.
+        :param deleted_hashes: An array of hashes of the image paths to delete.
+        :param generation: The generation being published.
+        :param found_hashes: A set to which the hashes of the deleted paths that were found are added.
+        :return: The manifest entry of the segment with its new deletion vector.
+        """
+        path_hashes = self._path_hashes(segment)
+        deleted = read_deleted_rows(self.directory, segment)
+        hits = [row_number for row_number in np.flatnonzero(np.isin(path_hashes, deleted_hashes)).tolist()
+                if row_number not in deleted]
+        if not hits:
+            return segment
+        found_hashes.update(path_hashes[hits].tolist())
+        deleted_rows = np.array(sorted(deleted.union(hits)), dtype=np.uint32)
+        name = deleted_rows_name(segment, generation)
+        temp_path = os.path.join(self.directory, f".{name}.tmp")
+        with open(temp_path, mode='wb') as file:
+            np.save(file, deleted_rows)
+        os.replace(temp_path, os.path.join(self.directory, name))
+        return dict(segment, deleted=name, deleted_rows=len(deleted_rows))
+
+    def _path_hashes(self, segment):
+        """
+        Return the hashes of the image paths of every row of a segment.
+
+        Segment files are immutable, so the hashes are computed once per segment and process.
+        """
+        name = segment["name"]
+        if name not in self._path_hashes_by_segment:
+            with open(os.path.join(self.directory, name), mode='r', newline='', encoding='utf-8') as file:
+                reader = csv.reader(file)
+                next(reader)
+                self._path_hashes_by_segment[name] = np.array([hash(row[0]) for row in reader], dtype=np.int64)
+        return self._path_hashes_by_segment[name]
+
+    def collect_garbage(self, timeout=None):
+        """
+        Delete segments and manifests that no current or pinned generation refers to.
+
+        :param timeout: Seconds to wait for the writer lock, which keeps a concurrent writer's
+            not yet published segments from being collected. Defaults to LOCK_TIMEOUT.
+        """
+        with self._writer_lock(timeout):
+            self._collect_garbage()
+
+    def _collect_garbage(self):
+        """Delete unreferenced segments and manifests. Must be called with the writer lock held."""
+        live_generations = {self._read_current()} | self._pinned_generations()
+        live_files = {CURRENT_FILE, LOCK_FILE, MERGE_LOCK_FILE, PINS_DIR}
+        live_stems = set()
+        for generation in live_generations:
+            try:
+                manifest = self._read_manifest(generation)
+            except FileNotFoundError:
+                continue
+            live_files.add(manifest_name(generation))
+            for segment in manifest["segments"]:
+                live_stems.add(file_stem(segment["name"]))
+                if "deleted" in segment:
+                    live_files.add(segment["deleted"])
+        for name in os.listdir(self.directory):
+            if name in live_files or not name.startswith(("manifest-", "segment-")):
+                continue
+            if file_stem(name) in live_stems and DELETED_MARKER not in name:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError as e:
+                print(f"Error: {e}")
+
+    def _pinned_generations(self):
+        """Return the generations pinned by readers, ignoring pins left by crashed processes."""
+        generations = set()
+        now = time.time()
+        for name in os.listdir(self.pins_dir):
+            path = os.path.join(self.pins_dir, name)
+            try:
+                if now - os.path.getmtime(path) > STALE_PIN_SECONDS:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            generations.add(int(name.split("-", 1)[0]))
+        return generations
+
+    def _read_current(self):
+        """Return the generation CURRENT points to."""
+        with open(self.current_path, mode='r') as file:
+            return int(file.read().strip())
+
+    def _read_manifest(self, generation):
+        """Return the manifest of a generation."""
+        with open(os.path.join(self.directory, manifest_name(generation)), mode='r') as file:
+            return json.load(file)
+
+    def _write_manifest(self, manifest):
+        """
+        Write a manifest and make it current, forgetting the path hashes of segments it drops.
+
+        Must be called with the writer lock held.
+        """
+        self._write_atomically(manifest_name(manifest["generation"]), json.dumps(manifest))
+        self._write_atomically(CURRENT_FILE, str(manifest["generation"]))
+        names = {segment["name"] for segment in manifest["segments"]}
+        for name in list(self._path_hashes_by_segment):
+            if name not in names:
+                del self._path_hashes_by_segment[name]
+
+    def _write_segment(self, name, rows):
+        """
+        Write rows, and the sidecar files built from them, to a new segment and return its manifest entry.
+
+        Rows are streamed to the segment file one at a time, and the indexers then read them back
+        from the file, so writing a segment never holds all of its rows in memory. Besides the
+        indexers' sidecars, the byte offset of the header and of every row is saved so that single
+        rows can be read without scanning the segment.
+
+        :param name: The file name of the new segment.
+        :param rows: An iterable of rows, each a list of values in index header order.
+        """
+        path = os.path.join(self.directory, name)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        offsets = array('Q', [0])
+        temp_path = os.path.join(self.directory, f".{name}.tmp")
+        with open(temp_path, mode='wb') as file:
+            for row in itertools.chain([INDEX_HEADER], rows):
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerow(row)
+                data = buffer.getvalue().encode('utf-8')
+                file.write(data)
+                offsets.append(offsets[-1] + len(data))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        offsets_name = file_stem(name) + OFFSETS_SUFFIX
+        temp_path = os.path.join(self.directory, f".{offsets_name}.tmp")
+        with open(temp_path, mode='wb') as file:
+            np.save(file, np.frombuffer(offsets, dtype=np.uint64))
+        os.replace(temp_path, os.path.join(self.directory, offsets_name))
+        for indexer in self.indexers:
+            with open(path, mode='r', newline='', encoding='utf-8') as file:
+                reader = csv.reader(file)
+                next(reader)
+                indexer.build_index(path, reader)
+        return {"name": name, "rows": len(offsets) - 2}
+
+    def _merge_segments(self, segments):
+        """
+        Concatenate the live rows of segments, in order, into a new segment file and return its manifest entry.
+
+        The segment is written under a temporary MERGING_PREFIX name, which garbage collection
+        leaves alone, until it is swapped in. Rows are streamed from the merged segments into the
+        new one, so merging holds no more than one row in memory however large the segments are.
+        """
+        rows = ([row.get(column) or '' for column in INDEX_HEADER]
+                for segment in segments for _, row in read_segment_rows(self.directory, segment))
+        return self._write_segment(f"{MERGING_PREFIX}{uuid.uuid4().hex}.csv", rows)
+
+    def _write_atomically(self, name, content):
+        """Replace a file in the index directory with new content in a single rename."""
+        temp_path = os.path.join(self.directory, f".{name}.tmp")
+        with open(temp_path, mode='w') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, os.path.join(self.directory, name))
+
+    @contextmanager
+    def _writer_lock(self, timeout=None):
+        """
+        Serialise writers with an exclusive lock on the lock file. Readers never wait for it.
+
+        :param timeout: Seconds to wait for another writer before raising LockTimeoutError. Defaults to LOCK_TIMEOUT.
+        """
+        with self._file_lock(LOCK_FILE, LOCK_TIMEOUT if timeout is None else timeout) as locked:
+            if not locked:
+                raise LockTimeoutError(f"Timed out waiting for index writer lock {self.lock_path}")
+            yield
+
+    @contextmanager
+    def _file_lock(self, name, timeout):
+        """
+        Hold an exclusive flock on a lock file in the index directory.
+
+        The lock is released when the file is closed, including when the process holding it dies,
+        so a crashed writer never leaves the index locked and a live writer's lock is never taken over.
+
+        :param name: The file name of the lock file.
+        :param timeout: Seconds to wait for the lock.
+        :return: A context manager yielding True if the lock is held, or False if it timed out.
+        """
+        deadline = time.monotonic() + timeout
+        with open(os.path.join(self.directory, name), mode='a') as file:
+            while True:
+                try:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        yield False
+                        return
+                    time.sleep(0.05)
+            try:
+                yield True
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
@@ -1,7 +1,26 @@
 from abc import ABC, abstractmethod
+import heapq
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
-from object_detector import encode_labels
+from object_detector import LABEL_NAMES, encode_labels
+
+DEFAULT_CHUNK_SIZE = 1024
+
+# Rough upper bound on the memory used per row of a scoring chunk: the float64 label
+# vector built by cosine_similarity, the uint8 label row and mask it is expanded from,
+# and the row's key and item.
+ESTIMATED_ROW_BYTES = len(LABEL_NAMES) * 9 + 256
+
+def chunk_size_for_memory(max_memory_mb):
+    """
+    Return the number of index rows that can be scored at once within a memory ceiling.
+
+    :param max_memory_mb: The memory ceiling in megabytes, or None for the default chunk size.
+    :return: The number of rows per chunk (at least 1).
+    """
+    if max_memory_mb is None:
+        return DEFAULT_CHUNK_SIZE
+    return max(1, int(max_memory_mb * 1024 * 1024) // ESTIMATED_ROW_BYTES)
 
 class SimilarityMetric(ABC):
     """Abstract base class for a similarity metric."""
@@ -15,6 +34,16 @@ class SimilarityMetric(ABC):
         :param other_labels: The labels of the other data for comparison.
         """
 
+    @abstractmethod
+    def calculate_similarities(self, input_labels, label_matrix):
+        """
+        Calculate the similarity between a set of labels and each row of an encoded label matrix.
+
+        :param input_labels: The labels of the input data.
+        :param label_matrix: A matrix of encoded labels, one row per item to compare against.
+        :return: An array of similarity scores, one per row of label_matrix.
+        """
+
 class CosineSimilarityMetric(SimilarityMetric):
     """Implementation of the Cosine Similarity metric."""
 
@@ -33,6 +62,21 @@ class CosineSimilarityMetric(SimilarityMetric):
             print(f"Error in similarity calculation: {e}")
             return 0.0
 
+    def calculate_similarities(self, input_labels, label_matrix):
+        """
+        Calculate the cosine similarity between a set of labels and each row of an encoded label matrix.
+
+        :param input_labels: The labels of the input data.
+        :param label_matrix: A matrix of encoded labels, one row per item to compare against.
+        :return: An array of similarity scores, one per row of label_matrix.
+        """
+        try:
+            input_labels_vector = np.array(encode_labels(input_labels)).reshape(1, -1)
+            return cosine_similarity(input_labels_vector, label_matrix)[0]
+        except Exception as e:
+            print(f"Error in similarity calculation: {e}")
+            return np.zeros(len(label_matrix))
+
 class ISimilarityUtility(ABC):
     """Abstract base class for a similarity utility."""
 
@@ -45,7 +89,18 @@ class ISimilarityUtility(ABC):
         :param input_labels: The labels of the input data for comparison.
         """
 
-class SimilarityUtility():
+    @abstractmethod
+    def process_top_k_label_matrices(self, chunks, input_labels, k, min_score=None):
+        """
+        Calculate similarity scores for chunks of encoded labels, keeping only the k best.
+
+        :param chunks: An iterable of (keys, items, label matrix) chunks.
+        :param input_labels: The labels of the input data for comparison.
+        :param k: The number of best scores to keep.
+        :param min_score: If given, scores below this value are discarded.
+        """
+
+class SimilarityUtility(ISimilarityUtility):
     """Implementation of a similarity utility."""
 
     def __init__(self, similarity_metric):
@@ -65,3 +120,33 @@ class SimilarityUtility():
             similarity = self.similarity_metric.calculate_similarity(input_labels, other_labels)
             similarity_scores.append((other_image_path, similarity))
         return similarity_scores
+
+    def process_top_k_label_matrices(self, chunks, input_labels, k, min_score=None):
+        """
+        Calculate similarity scores for chunks of encoded labels, keeping only the k best.
+
+        Each chunk is scored in a single vectorised call and only its k best rows, selected with
+        one sort, reach the heap, so memory use is bounded by the chunk size and k rather than by
+        the number of indexed images. Ties keep the row with the smaller key.
+
+        :param chunks: An iterable of (keys, items, label matrix) chunks: increasing integer keys ordering
+            the rows, the item to return for each row, and the encoded labels of each row.
+        :param input_labels: The labels of the input data for comparison.
+        :param k: The number of best scores to keep.
+        :param min_score: If given, scores below this value are discarded.
+        :return: A list of at most k (item, similarity score) pairs, best first.
+        """
+        heap = []
+        for keys, items, label_matrix in chunks:
+            similarities = np.asarray(self.similarity_metric.calculate_similarities(input_labels, label_matrix))
+            positions = np.arange(len(similarities))
+            if min_score is not None:
+                positions = positions[similarities >= min_score]
+            best = positions[np.lexsort((keys[positions], -similarities[positions]))[:k]]
+            for position in best.tolist():
+                entry = (float(similarities[position]), -int(keys[position]), items[position])
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, entry)
+        return [(item, similarity) for similarity, _, item in sorted(heap, key=lambda entry: entry[:2], reverse=True)]
@@ -0,0 +1,166 @@
+import os
+from array import array
+from abc import ABC, abstractmethod
+import numpy as np
+from object_detector import ALL_LABELS
+from segment_store import INDEX_HEADER, ISegmentIndexer, file_stem
+
+# Box centres are bucketed into a GRID_SIZE x GRID_SIZE grid over the normalised image.
+GRID_SIZE = 8
+
+BOXES_SUFFIX = '.boxes.npz'
+
+# Boxes sidecars are keyed by COCO class id rather than by position in LABEL_NAMES, so the
+# keys of sidecars already written stay valid however the label vocabulary is ordered.
+LABEL_CLASS_IDS = {label: cls for cls, label in ALL_LABELS.items()}
+
+DETECTIONS_COLUMN = INDEX_HEADER.index("Detections")
+
+def encode_detections(detections):
+    """
+    Encode detections as text for the Detections column of an index segment.
+
+    :param detections: A list of (label, score, ymin, xmin, ymax, xmax) detections.
+    :return: The detections as 'label:score:ymin:xmin:ymax:xmax' entries joined with ';'.
+    """
+    return ";".join(f"{label}:{score:.4f}:{ymin:.4f}:{xmin:.4f}:{ymax:.4f}:{xmax:.4f}"
+                    for label, score, ymin, xmin, ymax, xmax in detections)
+
+def decode_detections(text):
+    """
+    Decode the Detections column of an index segment.
+
+    :param text: The encoded detections, possibly empty or None.
+    :return: A list of (label, score, ymin, xmin, ymax, xmax) detections.
+    """
+    detections = []
+    for entry in (text or "").split(";"):
+        if entry:
+            label, *values = entry.split(":")
+            detections.append((label, *map(float, values)))
+    return detections
+
+def boxes_path(segment_path):
+    """Return the path of the boxes sidecar of a segment."""
+    directory, name = os.path.split(segment_path)
+    return os.path.join(directory, file_stem(name) + BOXES_SUFFIX)
+
+def grid_cell(coordinate):
+    """Return the grid row or column containing a normalised coordinate."""
+    return np.clip((np.asarray(coordinate) * GRID_SIZE).astype(np.int64), 0, GRID_SIZE - 1)
+
+class RegionQuery:
+    """Positional predicates a detection must satisfy to match a query term."""
+
+    def __init__(self, region=None, min_area=None, max_area=None, min_confidence=None):
+        """
+        Initialise the RegionQuery.
+
+        :param region: An optional (x0, y0, x1, y1) region, normalised to [0, 1], that must contain the box centre.
+        :param min_area: An optional minimum box area as a fraction of the frame.
+        :param max_area: An optional maximum box area as a fraction of the frame.
+        :param min_confidence: An optional minimum detection score.
+        """
+        self.region = region
+        self.min_area = min_area
+        self.max_area = max_area
+        self.min_confidence = min_confidence
+
+    def is_empty(self):
+        """Return True if the query places no constraint on detections."""
+        return all(value is None for value in (self.region, self.min_area, self.max_area, self.min_confidence))
+
+class ISpatialIndex(ABC):
+    """Abstract base class for a per-segment spatial index over detection boxes."""
+
+    @abstractmethod
+    def find_rows(self, segment_path, label, region_query):
+        """
+        Find the rows of a segment with a detection of a label satisfying a region query.
+
+        :param segment_path: The path of the segment.
+        :param label: The label the detection must have.
+        :param region_query: The RegionQuery the detection must satisfy.
+        :return: A sorted array of matching row numbers within the segment.
+        """
+
+class GridSpatialIndex(ISpatialIndex, ISegmentIndexer):
+    """
+    Spatial index storing each segment's detections in flat arrays sorted by (label, grid cell).
+
+    Detections are keyed by class id * GRID_SIZE**2 + the grid cell of their box centre, so the
+    detections of one label in one row of grid cells form a contiguous, binary-searchable range.
+    """
+
+    def build_index(self, segment_path, rows):
+        """
+        Write the boxes sidecar of a segment from its Detections column.
+
+        :param segment_path: The path the segment is written to.
+        :param rows: The rows of the segment, each a list of values in index header order.
+        """
+        # Detections are accumulated in typed arrays, a few bytes each, rather than in lists of
+        # Python objects, so indexing a large merged segment stays compact.
+        row_numbers, class_ids, scores, boxes = array('I'), array('I'), array('f'), array('f')
+        for row_number, row in enumerate(rows):
+            text = row[DETECTIONS_COLUMN] if len(row) > DETECTIONS_COLUMN else ""
+            for label, score, *box in decode_detections(text):
+                if label in LABEL_CLASS_IDS:
+                    row_numbers.append(row_number)
+                    class_ids.append(LABEL_CLASS_IDS[label])
+                    scores.append(score)
+                    boxes.extend(box)
+        boxes = np.frombuffer(boxes, dtype=np.float32).reshape(-1, 4)
+        centre_y = (boxes[:, 0] + boxes[:, 2]) / 2
+        centre_x = (boxes[:, 1] + boxes[:, 3]) / 2
+        keys = (np.frombuffer(class_ids, dtype=np.uint32).astype(np.int64) * GRID_SIZE ** 2
+                + grid_cell(centre_y) * GRID_SIZE + grid_cell(centre_x))
+        order = np.argsort(keys, kind='stable')
+        path = boxes_path(segment_path)
+        temp_path = path + '.tmp'
+        with open(temp_path, mode='wb') as file:
+            np.savez(file,
+                     keys=keys[order].astype(np.uint32),
+                     rows=np.frombuffer(row_numbers, dtype=np.uint32)[order],
+                     scores=np.frombuffer(scores, dtype=np.float32)[order],
+                     boxes=boxes[order])
+        os.replace(temp_path, path)
+
+    def find_rows(self, segment_path, label, region_query):
+        """
+        Find the rows of a segment with a detection of a label satisfying a region query.
+
+        Only the key ranges of grid cells overlapping the query region are read; the exact
+        region, size and confidence predicates are then applied to those candidates.
+
+        :param segment_path: The path of the segment.
+        :param label: The label the detection must have.
+        :param region_query: The RegionQuery the detection must satisfy.
+        :return: A sorted array of matching row numbers within the segment.
+        """
+        path = boxes_path(segment_path)
+        if label not in LABEL_CLASS_IDS or not os.path.exists(path):
+            return np.empty(0, dtype=np.uint32)
+        with np.load(path) as data:
+            keys, rows, scores, boxes = data['keys'], data['rows'], data['scores'], data['boxes']
+        base = LABEL_CLASS_IDS[label] * GRID_SIZE ** 2
+        x0, y0, x1, y1 = region_query.region if region_query.region is not None else (0.0, 0.0, 1.0, 1.0)
+        first_column, last_column = grid_cell(x0), grid_cell(x1)
+        candidates = []
+        for grid_row in range(grid_cell(y0), grid_cell(y1) + 1):
+            start = np.searchsorted(keys, base + grid_row * GRID_SIZE + first_column, side='left')
+            end = np.searchsorted(keys, base + grid_row * GRID_SIZE + last_column, side='right')
+            candidates.append(np.arange(start, end))
+        candidates = np.concatenate(candidates) if candidates else np.empty(0, dtype=np.int64)
+        candidate_boxes = boxes[candidates]
+        centre_y = (candidate_boxes[:, 0] + candidate_boxes[:, 2]) / 2
+        centre_x = (candidate_boxes[:, 1] + candidate_boxes[:, 3]) / 2
+        area = (candidate_boxes[:, 2] - candidate_boxes[:, 0]) * (candidate_boxes[:, 3] - candidate_boxes[:, 1])
+        mask = (centre_x >= x0) & (centre_x <= x1) & (centre_y >= y0) & (centre_y <= y1)
+        if region_query.min_area is not None:
+            mask &= area >= region_query.min_area
+        if region_query.max_area is not None:
+            mask &= area <= region_query.max_area
+        if region_query.min_confidence is not None:
+            mask &= scores[candidates] >= region_query.min_confidence
+        return np.unique(rows[candidates[mask]])
@@ -9,11 +9,31 @@ from matching_engine import *
 from object_detection_engine import *
 from image_search_manager import *
 from object_detector import *
+from segment_store import *
+from spatial_index import *
+from directory_sync import *
+from perceptual_hash import *
+from label_index import *
+from pathlib import Path
+from PIL import Image
 
 @pytest.fixture
 def image_search_manager():
     return ImageSearchManager('default')
 
+@pytest.fixture
+def tmp_index_access(tmp_path):
+    index_access = IndexAccess(str(tmp_path / 'index'))
+    index_access.setup_csv_file()
+    return index_access
+
+@pytest.fixture
+def stub_manager(tmp_path):
+    manager = ImageSearchManager('default', str(tmp_path / 'index'))
+    manager.object_detection_engine = DefaultObjectDetectionEngine(
+        lambda image: {'cat'}, lambda image: [('cat', 0.9, 0.0, 0.0, 1.0, 1.0)], lambda: 'test')
+    return manager
+
 def test_ingest_image(image_search_manager):
     image_search_manager.ingest_image('example_images/image1.jpg')
     image_search_manager.ingest_image('example_images/image4.jpg')
@@ -103,9 +123,170 @@ def test_similarity_utility():
     assert len(similarity_scores) == 0
     assert isinstance(similarity_scores, type([]))
 
+def test_top_k_similarity_scores():
+    utility = SimilarityUtility(CosineSimilarityMetric())
+    rows = [
+        {"Image_Path": "a.jpg", "Detected_Objects": "dog"},
+        {"Image_Path": "b.jpg", "Detected_Objects": "car,person"},
+        {"Image_Path": "c.jpg", "Detected_Objects": "car"},
+        {"Image_Path": "d.jpg", "Detected_Objects": "person,car"},
+        {"Image_Path": "e.jpg", "Detected_Objects": ""},
+    ]
+    input_labels = ['car', 'person']
+    expected = utility.process_similarity_scores(rows, input_labels)
+    expected.sort(key=lambda x: x[1], reverse=True)
+    matrix = np.array([encode_labels(row["Detected_Objects"].split(",")) for row in rows], dtype=np.uint8)
+    chunks = [(np.arange(start, start + 2), [row["Image_Path"] for row in rows[start:start + 2]], matrix[start:start + 2])
+              for start in range(0, len(rows), 2)]
+    top_k = utility.process_top_k_label_matrices(chunks, input_labels, 3)
+    assert [path for path, _ in top_k] == [path for path, _ in expected[:3]]
+    assert np.allclose([score for _, score in top_k], [score for _, score in expected[:3]])
+    above_cutoff = utility.process_top_k_label_matrices(chunks, input_labels, 5, min_score=0.5)
+    assert [path for path, _ in above_cutoff] == ['b.jpg', 'd.jpg', 'c.jpg']
+
+def test_top_k_identical_across_chunk_sizes(tmp_index_access):
+    assert chunk_size_for_memory(None) == DEFAULT_CHUNK_SIZE
+    assert chunk_size_for_memory(1) == 1024 * 1024 // ESTIMATED_ROW_BYTES
+    assert chunk_size_for_memory(0.0001) == 1
+    labels = [['car'], ['car', 'person'], ['dog'], [], ['person', 'car', 'dog'], ['person'], ['car', 'bus']]
+    for number in range(40):
+        tmp_index_access.save_image_data(f'{number}.jpg', labels[number % len(labels)])
+    tmp_index_access.delete_image_data(['1.jpg', '8.jpg'])
+    expected = tmp_index_access.calculate_top_k_similarity_scores(['car', 'person'], 10, min_score=0.5)
+    assert len(expected) == 10 and '1.jpg' not in [path for path, _ in expected]
+    assert all(score >= 0.5 for _, score in expected)
+    for chunk_size in [1, 3, 16, chunk_size_for_memory(0.01), chunk_size_for_memory(None)]:
+        assert tmp_index_access.calculate_top_k_similarity_scores(['car', 'person'], 10, min_score=0.5, chunk_size=chunk_size) == expected
+
+def test_segment_store_snapshot_isolation(tmp_path):
+    store = SegmentStore(str(tmp_path / 'index'))
+    store.setup()
+    store.publish([['a.jpg', 'car'], ['b.jpg', 'dog']])
+    with store.snapshot() as snapshot:
+        store.publish([['c.jpg', 'person']])
+        store.publish([['d.jpg', 'cat']])
+        assert [row["Image_Path"] for row in snapshot.rows()] == ['a.jpg', 'b.jpg']
+        pinned_segments = [segment["name"] for segment in snapshot.segments]
+    with store.snapshot() as snapshot:
+        assert [row["Image_Path"] for row in snapshot.rows()] == ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']
+        assert snapshot.count_rows() == 4
+        current_segments = {segment["name"] for segment in snapshot.segments}
+    leftover = set(os.listdir(tmp_path / 'index'))
+    assert leftover.isdisjoint(set(pinned_segments) - current_segments)
+    assert current_segments <= leftover
+
+def test_writer_lock_timeout_propagates(tmp_index_access, monkeypatch):
+    monkeypatch.setattr('segment_store.LOCK_TIMEOUT', 0.1)
+    with tmp_index_access.segment_store._writer_lock():
+        with pytest.raises(LockTimeoutError):
+            tmp_index_access.save_image_data('a.jpg', ['car'])
+    tmp_index_access.save_image_data('a.jpg', ['car'])
+    assert tmp_index_access.get_total_num_images() == 1
+
+def test_region_query(tmp_index_access):
+    tmp_index_access.save_image_data('left.jpg', ['person'], [('person', 0.9, 0.1, 0.05, 0.9, 0.25)])
+    tmp_index_access.save_image_data('right.jpg', ['person', 'car'], [('person', 0.8, 0.1, 0.7, 0.9, 0.9),
+                                                                      ('car', 0.4, 0.0, 0.0, 0.6, 0.6)])
+    tmp_index_access.save_image_data('none.jpg', [], [])
+    left_third = RegionQuery(region=(0.0, 0.0, 0.33, 1.0))
+    assert [path for path, _ in tmp_index_access.access_images_matching_regions(True, {'person'}, left_third)] == ['left.jpg']
+    large_cars = RegionQuery(min_area=0.3)
+    assert [path for path, _ in tmp_index_access.access_images_matching_regions(True, {'car'}, large_cars)] == ['right.jpg']
+    confident = RegionQuery(min_confidence=0.5)
+    assert tmp_index_access.access_images_matching_regions(True, {'person', 'car'}, confident) == []
+    assert len(tmp_index_access.access_images_matching_regions(False, {'person', 'car'}, confident)) == 2
+
+def test_replace_stale_images(tmp_index_access):
+    tmp_index_access.save_image_data('a.jpg', ['dog'], [('dog', 0.9, 0.0, 0.0, 0.5, 0.5)])
+    tmp_index_access.save_image_data('b.jpg', ['cat'], [('cat', 0.9, 0.0, 0.0, 0.5, 0.5)], 'default:old')
+    tmp_index_access.save_image_data('c.jpg', ['car'], [('car', 0.9, 0.0, 0.0, 0.5, 0.5)], 'default:new')
+    assert tmp_index_access.access_stale_images('default:new') == ['a.jpg', 'b.jpg']
+    tmp_index_access.replace_image_data([('b.jpg', ['person'], [('person', 0.9, 0.0, 0.0, 0.5, 0.5)], 'default:new'),
+                                         ('gone.jpg', ['person'], [], 'default:new')])
+    assert tmp_index_access.access_stale_images('default:new') == ['a.jpg']
+    assert tmp_index_access.get_total_num_images() == 3
+    assert sorted((path, label_names(mask)) for path, mask in tmp_index_access.read_image_data()) == [
+        ('a.jpg', ['dog']), ('b.jpg', ['person']), ('c.jpg', ['car'])]
+    assert tmp_index_access.access_images_matching_regions(True, {'cat'}, RegionQuery(min_confidence=0.5)) == []
+
+def test_redetect_records_unreadable_images(stub_manager, tmp_path, capsys):
+    corrupt_path = str(tmp_path / 'corrupt.jpg')
+    with open('example_images/image1.jpg', 'rb') as file:
+        (tmp_path / 'corrupt.jpg').write_bytes(file.read()[:2000])
+    manager = stub_manager
+    manager.index_access.save_image_data(corrupt_path, ['dog'], [], 'default:old')
+    manager.index_access.save_image_data('example_images/image3.jpg', ['dog'], [], 'default:old')
+    manager.redetect_stale_images(10)
+    assert "1 images re-detected, 1 images could not be read." in capsys.readouterr().out
+    assert manager.index_access.read_redetect_checkpoint('default:test')["failed"] == [corrupt_path]
+    manager.redetect_stale_images(10)
+    assert "0 images re-detected, 1 images could not be read." in capsys.readouterr().out
+
+def test_sync_directory(stub_manager, tmp_path, capsys, monkeypatch):
+    root = tmp_path / 'photos'
+    (root / 'nested').mkdir(parents=True)
+    (root / 'a.jpg').write_bytes((Path('example_images') / 'image1.jpg').read_bytes())
+    (root / 'b.jpg').write_bytes((Path('example_images') / 'image2.jpg').read_bytes())
+    (root / 'nested' / 'c.jpg').write_bytes((Path('example_images') / 'image3.jpg').read_bytes())
+    (root / 'notes.txt').write_text('not an image')
+    manager = stub_manager
+    manager.sync_directory(str(root), True, 2)
+    assert "3 added, 0 changed, 0 removed, 0 failed." in capsys.readouterr().out
+    manager.sync_directory(str(root), True, 2)
+    assert "0 added, 0 changed, 0 removed, 0 failed." in capsys.readouterr().out
+    os.utime(root / 'a.jpg', ns=(0, 0))
+    (root / 'b.jpg').write_bytes((Path('example_images') / 'image4.jpg').read_bytes())
+    os.remove(root / 'nested' / 'c.jpg')
+    (root / 'nested' / 'd.jpg').write_bytes((Path('example_images') / 'image5.jpg').read_bytes())
+    manager.sync_directory(str(root), True, 2)
+    assert "1 added, 1 changed, 1 removed, 0 failed." in capsys.readouterr().out
+    image_paths = sorted(path for path, _ in manager.index_access.read_image_data())
+    assert image_paths == sorted([str(root / 'a.jpg'), str(root / 'b.jpg'), str(root / 'nested' / 'd.jpg')])
+    monkeypatch.chdir(tmp_path)
+    manager.sync_directory('photos', True, 2)
+    assert "0 added, 0 changed, 0 removed, 0 failed." in capsys.readouterr().out
+    monkeypatch.chdir(root / 'nested')
+    manager.sync_directory('..', True, 2)
+    assert "0 added, 0 changed, 0 removed, 0 failed." in capsys.readouterr().out
+
+def test_near_duplicate_reuses_detections(stub_manager, tmp_path, capsys):
+    resized_path = str(tmp_path / 'resized.jpg')
+    with Image.open('example_images/image2.jpg') as image:
+        image.resize((image.width // 2, image.height // 2)).save(resized_path, quality=70)
+    hasher = DctPerceptualHasher()
+    assert hamming_distances([hasher.hash_image('example_images/image2.jpg')], hasher.hash_image(resized_path))[0] <= DUPLICATE_MAX_DISTANCE
+    detected = []
+    manager = stub_manager
+    detect_object_boxes = manager.object_detection_engine.detect_object_boxes
+    manager.object_detection_engine.detect_object_boxes = lambda image: detected.append(image) or detect_object_boxes(image)
+    manager.ingest_image('example_images/image2.jpg')
+    manager.ingest_image('example_images/image5.jpg')
+    manager.ingest_image(resized_path)
+    assert len(detected) == 2
+    assert f"{resized_path} is a near-duplicate of example_images/image2.jpg" in capsys.readouterr().out
+    assert ImageRecord(resized_path, label_mask(['cat'])) in manager.index_access.read_image_data()
+    in_frame = manager.index_access.access_images_matching_regions(True, {'cat'}, RegionQuery(min_confidence=0.5))
+    assert resized_path in [path for path, _ in in_frame]
+    similar = manager.index_access.calculate_top_k_similarity_scores(['cat'], 5)
+    assert resized_path not in [path for path, _ in similar]
+
+def test_label_masks(tmp_index_access):
+    mask = label_mask(['toothbrush', 'person', 'unknown'])
+    assert label_names(mask) == ['person', 'toothbrush']
+    assert label_matrix(mask_bytes(mask).reshape(1, -1)).tolist() == [encode_labels(['person', 'toothbrush'])]
+    tmp_index_access.upsert_image_data([('a.jpg', ['person', 'car'], [], 'test'), ('b.jpg', ['car'], [], 'test'),
+                                        ('c.jpg', ['dog'], [], 'test')])
+    tmp_index_access.delete_image_data(['b.jpg'])
+    assert tmp_index_access.access_matching_images(True, {'car', 'person'}) == [ImageRecord('a.jpg', label_mask(['car', 'person']))]
+    assert [path for path, _ in tmp_index_access.access_matching_images(False, {'dog', 'car', 'unknown'})] == ['a.jpg', 'c.jpg']
+    assert tmp_index_access.access_matching_images(True, {'dog', 'unknown'}) == []
+    assert tmp_index_access.calculate_top_k_similarity_scores(['dog'], 1) == [('c.jpg', 1.0)]
+    assert tmp_index_access.calculate_similarity_scores(['dog']) == [('c.jpg', 1.0), ('a.jpg', 0.0)]
+
 if __name__ == '__main__':
     pytest.main()
 
-# image_data.csv file should only contain Image_Path,Detected_Objects on the first line
+# image_data.csv file should only contain Image_Path,Detected_Objects on the first line,
+# and the image_index directory should not exist before the tests are run
 # warnings that may say 'Deprecated NumPy' is related to the deprecation of certain behavior in NumPy,
 # and it's not something that can be directly controlled in the code.
\ No newline at end of file